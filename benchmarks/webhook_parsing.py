@@ -0,0 +1,166 @@
+# Бенчмарк обработки обновления из вебхука телеграмма через FastAPI.
+# Сравнивает старый обработчик (параметр `update: dict`, который FastAPI разбирает и валидирует,
+# и повторная валидация словаря в Update) с новым (тело запроса как есть разбирается сразу в Update).
+# Запросы передаются приложению напрямую по ASGI, без сети, чтобы разница не терялась в шуме сокетов.
+# Пути чередуются по раундам, а результат - медиана разницы в парах соседних замеров,
+# поэтому дрейф частоты процессора и фоновая нагрузка влияют на оба пути одинаково.
+# Запуск: python benchmarks/webhook_parsing.py
+
+import asyncio
+import json
+import statistics
+import time
+
+from aiogram import Bot
+from aiogram.types import Update
+from fastapi import FastAPI, HTTPException, Request, Response
+from pydantic import ValidationError
+
+# Типичные обновления: текстовое сообщение, голосовое сообщение и нажатие на inline кнопку
+UPDATES = [
+    {
+        "update_id": 100000001,
+        "message": {
+            "message_id": 42,
+            "from": {"id": 123456789, "is_bot": False, "first_name": "Иван", "language_code": "ru"},
+            "chat": {"id": 123456789, "first_name": "Иван", "type": "private"},
+            "date": int(time.time()),
+            "text": "Когда начинается прием документов в электронном формате?",
+        },
+    },
+    {
+        "update_id": 100000002,
+        "message": {
+            "message_id": 43,
+            "from": {"id": 123456789, "is_bot": False, "first_name": "Иван", "language_code": "ru"},
+            "chat": {"id": 123456789, "first_name": "Иван", "type": "private"},
+            "date": int(time.time()),
+            "voice": {
+                "duration": 7,
+                "mime_type": "audio/ogg",
+                "file_id": "AwACAgIAAxkBAAIBQ2Z" + "x" * 50,
+                "file_unique_id": "AgADQ0kAAn2",
+                "file_size": 28413,
+            },
+        },
+    },
+    {
+        "update_id": 100000003,
+        "callback_query": {
+            "id": "4382bfdwdsb323b2d9",
+            "from": {"id": 123456789, "is_bot": False, "first_name": "Иван", "language_code": "ru"},
+            "message": {
+                "message_id": 44,
+                "from": {"id": 987654321, "is_bot": True, "first_name": "Бот", "username": "mpei_bot"},
+                "chat": {"id": 123456789, "first_name": "Иван", "type": "private"},
+                "date": int(time.time()),
+                "text": "Выберите город",
+            },
+            "chat_instance": "-1234567890",
+            "data": "city_Москва",
+        },
+    },
+]
+
+bot = Bot(token="42:TEST")
+dict_app = FastAPI()
+raw_app = FastAPI()
+
+
+# Старый обработчик: FastAPI разбирает JSON в словарь, затем aiogram валидирует словарь в Update
+@dict_app.post("/webhook")
+async def dict_webhook(
+    update: dict,
+    response: Response,
+):
+    Update.model_validate(update, context={"bot": bot})
+    response.status_code = 200
+
+
+# Новый обработчик: байты тела сразу разбираются и валидируются в Update
+@raw_app.post("/webhook")
+async def raw_webhook(
+    request: Request,
+    response: Response,
+):
+    try:
+        Update.model_validate_json(await request.body(), context={"bot": bot})
+    except ValidationError:
+        raise HTTPException(status_code=400, detail="Invalid update")
+    response.status_code = 200
+
+
+# Функция для отправки одного запроса приложению по ASGI, возвращает код ответа
+async def post(app: FastAPI, body: bytes) -> int:
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "POST",
+        "scheme": "https",
+        "path": "/webhook",
+        "raw_path": b"/webhook",
+        "query_string": b"",
+        "root_path": "",
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+        "client": ("127.0.0.1", 50000),
+        "server": ("127.0.0.1", 443),
+    }
+    status = 0
+
+    async def receive():
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+
+    await app(scope, receive, send)
+    return status
+
+
+# Функция для замера среднего времени обработки одного обновления в секундах
+async def measure(app: FastAPI, bodies: list[bytes], number: int) -> float:
+    started = time.perf_counter()
+    for _ in range(number):
+        for body in bodies:
+            await post(app, body)
+    return (time.perf_counter() - started) / (number * len(bodies))
+
+
+async def main():
+    bodies = [json.dumps(update, ensure_ascii=False).encode() for update in UPDATES]
+    # Оба обработчика должны принимать все обновления, а новый еще и отклонять невалидное тело
+    for body in bodies:
+        assert await post(dict_app, body) == 200
+        assert await post(raw_app, body) == 200
+    assert await post(raw_app, b"{") == 400
+
+    number = 300
+    rounds = 40
+    await measure(dict_app, bodies, number)
+    await measure(raw_app, bodies, number)
+    times = {"dict": [], "raw": []}
+    for i in range(rounds):
+        order = ("dict", "raw") if i % 2 == 0 else ("raw", "dict")
+        for name in order:
+            times[name].append(await measure(dict_app if name == "dict" else raw_app, bodies, number))
+
+    for name, values in times.items():
+        median = statistics.median(values)
+        print(
+            f"{name:>4}: median {median * 1e6:6.1f} us/update, "
+            f"min {min(values) * 1e6:6.1f}, max {max(values) * 1e6:6.1f}, {1 / median:8.0f} updates/s per core"
+        )
+    diffs = sorted(d - r for d, r in zip(times["dict"], times["raw"]))
+    # Примерный 95% интервал для медианы по порядковым статистикам
+    low, high = diffs[rounds // 2 - 7], diffs[rounds // 2 + 6]
+    print(
+        f"dict - raw: median {statistics.median(diffs) * 1e6:+.1f} us/update, "
+        f"95% CI [{low * 1e6:+.1f}, {high * 1e6:+.1f}], raw faster in {sum(d > 0 for d in diffs)}/{rounds} rounds"
+    )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
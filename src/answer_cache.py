@@ -0,0 +1,96 @@
+# Модуль для кэширования ответов LLM на часто задаваемые вопросы
+
+import hashlib
+import re
+from datetime import datetime
+from typing import Optional
+
+from cache import (
+    TTLCache,
+    MISSING,
+)
+from metrics import (
+    metrics,
+)
+from settings import (
+    settings,
+)
+from storage import (
+    storage,
+)
+
+# Все, что не является буквой, цифрой или пробелом, считаем пунктуацией
+PUNCTUATION_RE = re.compile(r"[^\w\s]|_")
+WHITESPACE_RE = re.compile(r"\s+")
+
+
+# Функция для приведения вопроса к нормальной форме: без регистра, пунктуации и лишних пробелов
+def normalize_question(question: str) -> str:
+    question = question.lower().replace("ё", "е")
+    question = PUNCTUATION_RE.sub(" ", question)
+    return WHITESPACE_RE.sub(" ", question).strip()
+
+
+# Кэш ответов LLM из двух уровней: LRU в памяти процесса и таблица в sqlite3
+class AnswerCache:
+    def __init__(
+        self,
+        maxsize: int,
+        ttl: int,
+    ):
+        self.ttl = ttl
+        self.memory = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.hits = 0
+        self.misses = 0
+
+    # Метод для получения ключа кэша, ключ зависит от вопроса и от настроек модели
+    @staticmethod
+    def key(question: str) -> str:
+        raw = "\n".join([settings.yandex_model_uri, str(settings.temperature_model), normalize_question(question)])
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    # Метод для получения ответа из кэша
+    async def get(self, question: str) -> Optional[str]:
+        key = self.key(question)
+        answer = self.memory.get(key)
+        if answer is MISSING:
+            answer = None
+            row = await storage.get_llm_answer(key)
+            if row is not None:
+                # В памяти ответ живет не дольше, чем его запись в базе данных
+                answer, valid_until = row
+                self.memory.set(key, answer, min(self.ttl, valid_until - datetime.now().timestamp()))
+        if answer is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return answer
+
+    # Метод для сохранения ответа в кэш
+    async def set(self, question: str, answer: str):
+        key = self.key(question)
+        self.memory.set(key, answer)
+        await storage.insert_llm_answer(key, answer, int(datetime.now().timestamp() + self.ttl))
+
+    # Метод для полной очистки кэша, например при смене настроек модели
+    async def clear(self):
+        self.memory.clear()
+        await storage.delete_all_llm_answers()
+
+    # Метод для получения статистики кэша
+    def stats(self) -> dict[str, float]:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / total if total else 0.0,
+            "memory_size": len(self.memory),
+            "memory_hit_ratio": self.memory.stats()["hit_ratio"],
+        }
+
+
+# Инициализируем инстанс кэша ответов
+answer_cache = AnswerCache(settings.answer_cache_size, settings.answer_cache_ttl)
+metrics.register_collector("answer_cache", answer_cache.stats)
+# Если настройки модели поменяли в другом процессе, он уже очистил таблицу, а нам нужно очистить память
+storage.subscribe("settings", lambda _: answer_cache.memory.clear())
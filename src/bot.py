@@ -1,5 +1,6 @@
 # Модуль для инициализации бота
 
+import math
 from typing import NoReturn
 
 from aiogram import (
@@ -12,12 +13,16 @@ from aiogram.enums import (
 from aiogram.filters import (
     ExceptionTypeFilter,
 )
+from aiogram.fsm.storage.base import (
+    StorageKey,
+)
 from aiogram.types import (
     ErrorEvent,
     BotCommand,
+    Update,
 )
-from aiogram.fsm.storage.memory import (
-    MemoryStorage,
+from aiogram.dispatcher.middlewares.user_context import (
+    UserContextMiddleware,
 )
 from loguru import (
     logger,
@@ -25,22 +30,48 @@ from loguru import (
 
 from exceptions import (
     TGUserNotFoundException,
+    QueueFullException,
+    UpstreamUnavailableException,
+    TooManyQuestionsException,
+)
+from dedup import (
+    RecentIds,
+)
+from fsm_storage import (
+    fsm_storage,
 )
 from middlewares import (
     UserMiddleware,
+    RateLimitMiddleware,
+    QuestionRateLimitMiddleware,
 )
 from handlers.bot.bot import (
     router,
+    UserState,
 )
 
 from settings import (
     settings,
 )
+from ratelimit import (
+    telegram_sender,
+    text_questions_limiter,
+    voice_questions_limiter,
+)
+from workers import (
+    ChatOrderedPool,
+)
 
 # Dispatcher - это рутовый роутер для направленмия обновления в соответствующий хендлер
-dp = Dispatcher(storage=MemoryStorage())
+# Состояния хранятся в базе данных, поэтому приложение можно запускать в нескольких процессах
+dp = Dispatcher(storage=fsm_storage)
 # Добавляем мидлварю для работы с пользователями
 dp.update.middleware(UserMiddleware())
+# Добавляем мидлварю, которая ограничивает частоту вопросов к LLM от одного пользователя.
+# Она добавляется на уровне хендлеров, потому что ей нужны флаги выбранного хендлера
+question_rate_limit = QuestionRateLimitMiddleware(text_questions_limiter, voice_questions_limiter)
+router.message.middleware(question_rate_limit)
+router.callback_query.middleware(question_rate_limit)
 
 # Добавляем роутер в наш рутовый роутер
 dp.include_router(router)
@@ -50,18 +81,90 @@ bot = Bot(
     token=settings.bot_token,
     parse_mode=ParseMode.HTML,
 )
+# Добавляем мидлварю, которая ограничивает частоту отправки сообщений под лимиты телеграмма
+bot.session.middleware(RateLimitMiddleware(telegram_sender, settings.tg_retry_after_retries))
+
+
+# Функция для обработки одного обновления из очереди
+async def process_update(
+    update: Update,
+):
+    await dp.feed_update(bot, update)
+
+
+# Пулы воркеров, которые обрабатывают обновления после того, как вебхук уже ответил телеграмму.
+# Быстрая очередь для меню и регистрации, медленная - для вопросов к LLM и распознавания голоса,
+# чтобы меню отвечало сразу, даже если вопросов к LLM накопилось много
+fast_pool = ChatOrderedPool(
+    "webhook_fast",
+    settings.webhook_fast_workers,
+    settings.webhook_fast_queue_size,
+    process_update,
+)
+slow_pool = ChatOrderedPool(
+    "webhook_slow",
+    settings.webhook_slow_workers,
+    settings.webhook_slow_queue_size,
+    process_update,
+)
+updates_pools = [fast_pool, slow_pool]
+
+
+# Недавно принятые update_id. Если вебхук отвечал долго, телеграмм доставляет то же обновление повторно
+recent_updates = RecentIds(
+    "webhook_dedup",
+    settings.webhook_dedup_size,
+    settings.webhook_dedup_window,
+)
+
+
+# Функция для выбора очереди для обновления и ключа, обновления с одинаковым ключом обрабатываются строго по порядку.
+# В медленную очередь попадают только сообщения от пользователя, который ждет ответа от LLM
+async def route_update(
+    update: Update,
+) -> tuple[ChatOrderedPool, int]:
+    chat, user, thread_id = UserContextMiddleware.resolve_event_context(update)
+    if chat is not None:
+        key = chat.id
+    elif user is not None:
+        key = user.id
+    else:
+        key = update.update_id
+    message = update.message
+    if message is None or chat is None or user is None:
+        return fast_pool, key
+    if (message.text is not None and message.text.startswith("/")) or (message.text is None and message.voice is None):
+        return fast_pool, key
+    # Если у чата еще есть необработанные быстрые обновления, состояние может вот-вот поменяться,
+    # поэтому сохраняем порядок и отправляем сообщение туда же
+    if fast_pool.pending(key):
+        return fast_pool, key
+    state = await fsm_storage.get_state(
+        StorageKey(bot_id=bot.id, chat_id=chat.id, user_id=user.id, thread_id=thread_id),
+    )
+    if state == UserState.wait_for_llm_question.state:
+        # Вопросы одного чата не ждут друг друга: новый вопрос должен дойти до обработчика,
+        # пока предыдущий еще отвечается, чтобы отменить его
+        return slow_pool, update.update_id
+    return fast_pool, key
 
 
 # Функция для установления вебхука на стороне телеграм
 async def set_webhook(
     bot: Bot,
 ) -> NoReturn:
+    url = f"{str(settings.webhook_url).rstrip('/')}{settings.webhook_path}"
     try:
+        # Если вебхук уже установлен, например другим процессом uvicorn, не трогаем его,
+        # иначе удаление вебхука выбросило бы обновления, которые ждут обработки
+        if (await bot.get_webhook_info()).url == url:
+            logger.info("Webhook is already set")
+            return
         # Удаляем старый вебхук
         await bot.delete_webhook(drop_pending_updates=True)
         # Устанавливаем новый вебхук
         await bot.set_webhook(
-            f"{str(settings.webhook_url).rstrip('/')}{settings.webhook_path}",
+            url,
             drop_pending_updates=True,
             max_connections=100,
         )
@@ -109,6 +212,45 @@ async def tg_user_not_found_exception_handler(
     await message.answer("Такое ощущение, что вы не зарегистрированы в нашей системе. Пожалуйста, введите /start")
 
 
+# Обработчик исключения QueueFullException
+@dp.error(ExceptionTypeFilter(QueueFullException))
+async def queue_full_exception_handler(
+    event: ErrorEvent,
+):
+    message = event.update.message
+    if event.update.callback_query is not None:
+        await event.update.callback_query.answer()
+        message = event.update.callback_query.message
+    await message.answer("Сейчас очень много вопросов, пожалуйста, попробуйте спросить через пару минут")
+
+
+# Обработчик исключения UpstreamUnavailableException
+@dp.error(ExceptionTypeFilter(UpstreamUnavailableException))
+async def upstream_unavailable_exception_handler(
+    event: ErrorEvent,
+):
+    message = event.update.message
+    if event.update.callback_query is not None:
+        await event.update.callback_query.answer()
+        message = event.update.callback_query.message
+    await message.answer("Сервис ответов сейчас перегружен, пожалуйста, попробуйте спросить чуть позже")
+
+
+# Обработчик исключения TooManyQuestionsException
+@dp.error(ExceptionTypeFilter(TooManyQuestionsException))
+async def too_many_questions_exception_handler(
+    event: ErrorEvent,
+):
+    text = (
+        f"Вы задаете вопросы слишком часто, пожалуйста, попробуйте через {math.ceil(event.exception.retry_after)} сек."
+    )
+    if event.update.callback_query is not None:
+        # Сообщение с кнопкой может быть уже недоступно, поэтому отвечаем прямо на нажатие кнопки
+        await event.update.callback_query.answer(text, show_alert=True)
+        return
+    await event.update.message.answer(text)
+
+
 # Обработка любых других исключений
 @dp.error()
 async def error_handler(
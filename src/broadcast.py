@@ -0,0 +1,159 @@
+# Модуль для рассылки сообщения всем зарегистрированным пользователям
+
+import asyncio
+import uuid
+from typing import NoReturn, Optional
+
+from aiogram.exceptions import (
+    TelegramAPIError,
+)
+from loguru import (
+    logger,
+)
+
+from bot import (
+    bot,
+)
+from metrics import (
+    metrics,
+)
+from models import (
+    Broadcast,
+)
+from ratelimit import (
+    TokenBucket,
+)
+from settings import (
+    settings,
+)
+from storage import (
+    storage,
+)
+
+
+# Класс для отправки рассылок. Пользователи читаются из базы данных пачками по id,
+# каждая пачка отправляется параллельно, а после нее прогресс сохраняется в базу данных.
+# Если процесс перезапустится, незаконченную рассылку подхватит этот или другой процесс
+# и продолжит с последней сохраненной пачки
+class Broadcaster:
+    def __init__(
+        self,
+        chunk_size: int,
+        concurrency: int,
+        rate: float,
+        lease: int,
+    ):
+        self.chunk_size = chunk_size
+        self.concurrency = concurrency
+        self.lease = lease
+        # Уникальный идентификатор процесса, по нему видно, кто сейчас отправляет рассылку
+        self.owner = uuid.uuid4().hex
+        # Рассылка отправляется медленнее общего лимита телеграмма, чтобы ответы пользователям не ждали ее
+        self.bucket = TokenBucket(rate, rate)
+        self._tasks: dict[int, asyncio.Task] = {}
+        self._resume_task: Optional[asyncio.Task] = None
+
+    # Метод для создания и запуска новой рассылки
+    async def start_broadcast(self, text: str) -> Broadcast:
+        broadcast = await storage.create_broadcast(text, await storage.count_all_users(), self.owner)
+        self.spawn(broadcast)
+        return broadcast
+
+    # Метод для запуска задачи, которая отправляет рассылку
+    def spawn(self, broadcast: Broadcast):
+        task = asyncio.create_task(self.run(broadcast))
+        self._tasks[broadcast.id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(broadcast.id, None))
+
+    # Метод для запуска фоновой задачи, которая подхватывает незаконченные рассылки
+    def start(self):
+        self._resume_task = asyncio.create_task(self.resume_loop())
+
+    # Метод для остановки всех рассылок этого процесса, прогресс остается в базе данных
+    async def close(self) -> NoReturn:
+        tasks = list(self._tasks.values())
+        if self._resume_task is not None:
+            tasks.append(self._resume_task)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    # Цикл, который раз в lease секунд забирает рассылки, брошенные остановившимися процессами
+    async def resume_loop(self):
+        while True:
+            try:
+                for broadcast in await storage.claim_stale_broadcasts(self.owner, self.lease):
+                    if broadcast.id not in self._tasks:
+                        logger.info(f"Resuming broadcast {broadcast.id} from user id {broadcast.last_user_id}")
+                        self.spawn(broadcast)
+            except Exception:
+                logger.exception("Failed to resume broadcasts")
+            await asyncio.sleep(self.lease)
+
+    # Цикл, который продлевает захват рассылки, пока она отправляется: пачка может отправляться дольше lease секунд.
+    # Если рассылку уже забрал другой процесс, останавливаем отправку sender, чтобы не отправлять сообщения дважды
+    async def keep_lease(self, broadcast: Broadcast, sender: asyncio.Task):
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            try:
+                if not await storage.heartbeat_broadcast(broadcast.id, self.owner):
+                    logger.warning(f"Broadcast {broadcast.id} was taken over by another process")
+                    sender.cancel()
+                    return
+            except Exception:
+                logger.exception(f"Failed to extend lease of broadcast {broadcast.id}")
+
+    # Метод для отправки рассылки начиная с пользователя, на котором она остановилась
+    async def run(self, broadcast: Broadcast):
+        heartbeat = asyncio.create_task(self.keep_lease(broadcast, asyncio.current_task()))
+        try:
+            await self.send_all(broadcast)
+        finally:
+            heartbeat.cancel()
+
+    # Метод для отправки рассылки по пачкам пользователей с сохранением прогресса после каждой пачки
+    async def send_all(self, broadcast: Broadcast):
+        last_user_id = broadcast.last_user_id
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def send(tg_user_id: int) -> bool:
+            async with semaphore:
+                await asyncio.sleep(self.bucket.reserve())
+                try:
+                    # Текст рассылки отправляется как есть, без разбора HTML, иначе любой символ < ломал бы отправку
+                    await bot.send_message(tg_user_id, broadcast.text, parse_mode=None)
+                except TelegramAPIError as e:
+                    # Пользователь заблокировал бота или удалил чат, рассылку это не останавливает
+                    logger.debug(f"Broadcast {broadcast.id} to {tg_user_id} failed: {e}")
+                    return False
+                except Exception:
+                    logger.exception(f"Broadcast {broadcast.id} to {tg_user_id} failed")
+                    return False
+            return True
+
+        while True:
+            users = await storage.list_users_after(last_user_id, self.chunk_size)
+            results = await asyncio.gather(*(send(tg_user_id) for _, tg_user_id in users))
+            sent = sum(results)
+            metrics.inc("broadcast.sent", sent)
+            metrics.inc("broadcast.failed", len(results) - sent)
+            if users:
+                last_user_id = users[-1][0]
+            finished = len(users) < self.chunk_size
+            if not await storage.checkpoint_broadcast(
+                broadcast.id, self.owner, last_user_id, sent, len(results) - sent, finished
+            ):
+                logger.warning(f"Broadcast {broadcast.id} was taken over by another process")
+                return
+            if finished:
+                logger.info(f"Broadcast {broadcast.id} finished")
+                return
+
+
+# Инициализируем инстанс для отправки рассылок
+broadcaster = Broadcaster(
+    settings.broadcast_chunk_size,
+    settings.broadcast_concurrency,
+    settings.broadcast_rate,
+    settings.broadcast_lease,
+)
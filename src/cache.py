@@ -0,0 +1,77 @@
+# Модуль с кэшами, которые хранятся в памяти процесса
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+# Значение, которое возвращается если ключа нет в кэше.
+# Нужно, чтобы отличать отсутствие ключа от закэшированного None
+MISSING = object()
+
+
+# Ограниченный по размеру кэш с вытеснением давно неиспользуемых записей (LRU) и временем жизни записей (TTL).
+# Кэш потокобезопасный, так как им пользуются и event loop, и потоки пула базы данных
+class TTLCache:
+    def __init__(
+        self,
+        maxsize: int,
+        ttl: float,
+    ):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+        # Счетчики для отслеживания эффективности кэша
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # Метод для получения значения по ключу, возвращает MISSING если ключа нет или запись устарела
+    def get(self, key: Hashable) -> Any:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return MISSING
+            expires_at, value = item
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                self.misses += 1
+                return MISSING
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    # Метод для сохранения значения в кэш, ttl задает время жизни этой записи вместо общего
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        with self._lock:
+            self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    # Метод для удаления значения из кэша
+    def invalidate(self, key: Hashable):
+        with self._lock:
+            self._data.pop(key, None)
+
+    # Метод для полной очистки кэша
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    # Метод для получения статистики кэша
+    def stats(self) -> dict[str, float]:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": self.hits / total if total else 0.0,
+        }
@@ -0,0 +1,61 @@
+# Модуль для отслеживания изменений, которые сделали другие процессы, по журналу в базе данных
+
+import pathlib
+import sqlite3
+import threading
+from typing import Callable, Optional
+
+
+# Чтение журнала изменений table с колонками seq и columns.
+# PRAGMA data_version меняется, только когда в базу данных записало другое подключение,
+# поэтому пока никто ничего не менял, проверка не читает сам журнал.
+# Методы вызываются из пула потоков хранилища, подключение защищено блокировкой
+class ChangeLog:
+    def __init__(
+        self,
+        db_path: pathlib.Path,
+        table: str,
+        columns: str,
+    ):
+        self.db_path = db_path
+        self.table = table
+        self.columns = columns
+        self.last_seq = 0
+        self._conn: Optional[sqlite3.Connection] = None
+        self._data_version: Optional[int] = None
+        self._lock = threading.Lock()
+
+    # Метод для получения подключения, при первом вызове запоминаем текущий конец журнала
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._conn.execute("PRAGMA busy_timeout=5000")
+            self.last_seq = self._conn.execute(f"SELECT COALESCE(MAX(seq), 0) FROM {self.table}").fetchone()[0]
+            self._data_version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+        return self._conn
+
+    # Метод для чтения новых изменений, apply вызывается со строками seq и columns в порядке seq,
+    # или с None, если часть журнала уже удалена и неизвестно, что изменилось.
+    # apply выполняется под блокировкой, поэтому после возврата из read любого потока
+    # все изменения, которые он увидел, уже применены
+    def read(self, apply: Callable[[Optional[list[tuple]]], None]):
+        with self._lock:
+            conn = self.conn()
+            data_version = conn.execute("PRAGMA data_version").fetchone()[0]
+            if data_version == self._data_version:
+                return
+            changes = conn.execute(
+                f"SELECT seq, {self.columns} FROM {self.table} WHERE seq > ? ORDER BY seq",
+                (self.last_seq,),
+            ).fetchall()
+            if changes:
+                apply(changes if changes[0][0] == self.last_seq + 1 else None)
+                self.last_seq = changes[-1][0]
+            self._data_version = data_version
+
+    # Метод для закрытия подключения
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
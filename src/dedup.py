@@ -0,0 +1,61 @@
+# Модуль для отбрасывания повторно доставленных обновлений телеграмма
+
+import time
+from collections import deque
+from typing import Hashable
+
+from metrics import (
+    metrics,
+)
+from storage import (
+    storage,
+)
+
+
+# Множество недавно увиденных идентификаторов, ограниченное по размеру и по времени.
+# Кольцевой буфер хранит порядок добавления, а множество дает быструю проверку наличия.
+# Общий для всех процессов список хранится в базе данных, а в памяти лежат идентификаторы,
+# которые видел этот процесс, чтобы повтор, пришедший в тот же процесс, не ходил в базу данных
+class RecentIds:
+    def __init__(
+        self,
+        name: str,
+        maxsize: int,
+        window: float,
+    ):
+        self.name = name
+        self.maxsize = maxsize
+        self.window = window
+        self._order: deque[tuple[float, Hashable]] = deque()
+        self._ids: set[Hashable] = set()
+        metrics.register_collector(name, self.stats)
+
+    # Метод для удаления идентификаторов, которые старше window секунд или не влезают в maxsize
+    def _evict(self, now: float):
+        while self._order and (len(self._order) > self.maxsize or self._order[0][0] <= now - self.window):
+            _, value = self._order.popleft()
+            self._ids.discard(value)
+
+    # Метод для захвата идентификатора. Возвращает False, если идентификатор уже захватил
+    # этот или другой процесс за последние window секунд, повторы считаются в метрике
+    async def claim(self, value: int) -> bool:
+        now = time.monotonic()
+        self._evict(now)
+        if value in self._ids or not await storage.claim_update(value, self.window):
+            metrics.inc(f"{self.name}.suppressed")
+            return False
+        self._order.append((now, value))
+        self._ids.add(value)
+        self._evict(now)
+        return True
+
+    # Метод для отмены захвата, когда обновление не удалось принять и телеграмм доставит его еще раз
+    async def release(self, value: int):
+        self._ids.discard(value)
+        await storage.release_update(value)
+
+    # Метод для получения метрик
+    def stats(self) -> dict[str, float]:
+        return {
+            "size": len(self._ids),
+        }
@@ -4,3 +4,25 @@
 # исключение для случая если пользватель не найден
 class TGUserNotFoundException(Exception):
     pass
+
+
+# исключение для случая если очередь запросов к LLM переполнена
+class QueueFullException(Exception):
+    pass
+
+
+# исключение для случая если внешний сервис yandex cloud сейчас недоступен или перегружен
+class UpstreamUnavailableException(Exception):
+    pass
+
+
+# исключение для случая если голосовое сообщение больше разрешенного размера
+class VoiceTooLargeException(Exception):
+    pass
+
+
+# исключение для случая если пользователь задает вопросы слишком часто
+class TooManyQuestionsException(Exception):
+    def __init__(self, retry_after: float):
+        super().__init__(retry_after)
+        self.retry_after = retry_after
@@ -0,0 +1,92 @@
+# Модуль для удаления сущностей (токенов, файлов и т.д.) ровно в момент окончания их действия
+
+import asyncio
+import heapq
+import itertools
+from collections import defaultdict
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Hashable, NoReturn, Optional
+
+from loguru import logger
+
+
+# Планировщик удаления по времени. Хранит кучу таймеров и спит до ближайшего из них,
+# поэтому не просыпается впустую и не сканирует таблицы целиком
+class ExpiryScheduler:
+    def __init__(
+        self,
+        batch_size: int = 500,
+    ):
+        # Максимальное количество ключей, которое передается обработчику за раз
+        self.batch_size = batch_size
+        self._heap: list[tuple[int, int, str, Hashable]] = []
+        # Счетчик нужен, чтобы куча не сравнивала ключи разных типов
+        self._counter = itertools.count()
+        self._handlers: dict[str, Callable[[list[Any]], Awaitable[Any]]] = {}
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self.fired = 0
+
+    # Метод для регистрации обработчика, который удаляет истекшие сущности определенного вида
+    def register(self, kind: str, handler: Callable[[list[Any]], Awaitable[Any]]):
+        self._handlers[kind] = handler
+
+    # Метод для добавления таймера, valid_until - unix timestamp окончания действия
+    def schedule(self, kind: str, key: Hashable, valid_until: int):
+        heapq.heappush(self._heap, (int(valid_until), next(self._counter), kind, key))
+        # Будим цикл только если новый таймер стал ближайшим
+        if self._wakeup is not None and self._heap[0][2:] == (kind, key):
+            self._wakeup.set()
+
+    # Метод для запуска фоновой задачи планировщика
+    def start(self):
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self.run())
+
+    # Метод для остановки фоновой задачи планировщика
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    # Основной цикл планировщика
+    async def run(self) -> NoReturn:
+        while True:
+            self._wakeup.clear()
+            timeout = None
+            if self._heap:
+                timeout = max(self._heap[0][0] - datetime.now().timestamp(), 0)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+                # Появился более ранний таймер, пересчитываем время сна
+                continue
+            except asyncio.TimeoutError:
+                pass
+            await self.fire_expired()
+
+    # Метод для вызова обработчиков для всех истекших таймеров
+    async def fire_expired(self):
+        now = datetime.now().timestamp()
+        expired: dict[str, list[Hashable]] = defaultdict(list)
+        while self._heap and self._heap[0][0] <= now:
+            _, _, kind, key = heapq.heappop(self._heap)
+            expired[kind].append(key)
+        for kind, keys in expired.items():
+            handler = self._handlers[kind]
+            for i in range(0, len(keys), self.batch_size):
+                batch = keys[i : i + self.batch_size]
+                try:
+                    await handler(batch)
+                except Exception as e:
+                    logger.exception(f"Critical error caused while deleting expired {kind}", e)
+                    continue
+                self.fired += len(batch)
+                logger.debug(f"Successfully deleted {len(batch)} expired {kind}")
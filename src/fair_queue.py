@@ -0,0 +1,130 @@
+# Модуль для ограничения количества одновременных запросов с честной очередью между пользователями
+
+import asyncio
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Awaitable, Callable, Hashable, Optional
+
+from loguru import (
+    logger,
+)
+
+import exceptions
+from metrics import (
+    metrics,
+)
+
+
+# Планировщик, который пропускает не больше max_in_flight запросов одновременно.
+# Остальные ждут в очереди, а освободившееся место отдается пользователям по кругу,
+# поэтому один пользователь с кучей вопросов не задерживает остальных
+class FairScheduler:
+    def __init__(
+        self,
+        name: str,
+        max_in_flight: int,
+        max_queue: int,
+    ):
+        self.name = name
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self._in_flight = 0
+        self._queued = 0
+        # Очереди ожидающих запросов каждого пользователя, порядок словаря - порядок обхода по кругу
+        self._queues: OrderedDict[Hashable, deque[asyncio.Future]] = OrderedDict()
+        metrics.register_collector(name, self.stats)
+
+    # Контекстный менеджер, который занимает место на время выполнения запроса.
+    # on_queued вызывается с позицией в очереди, если запрос не удалось выполнить сразу
+    @asynccontextmanager
+    async def slot(
+        self,
+        owner: Hashable,
+        on_queued: Optional[Callable[[int], Awaitable]] = None,
+    ) -> AsyncIterator[None]:
+        started = time.monotonic()
+        if self._in_flight < self.max_in_flight and self._queued == 0:
+            self._in_flight += 1
+        else:
+            await self._wait(owner, on_queued)
+        metrics.observe(f"{self.name}.wait_seconds", time.monotonic() - started)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            metrics.observe(f"{self.name}.service_seconds", time.monotonic() - started)
+            self._release()
+
+    # Метод для ожидания своей очереди
+    async def _wait(
+        self,
+        owner: Hashable,
+        on_queued: Optional[Callable[[int], Awaitable]],
+    ):
+        if self._queued >= self.max_queue:
+            metrics.inc(f"{self.name}.rejected")
+            raise exceptions.QueueFullException()
+        future = asyncio.get_running_loop().create_future()
+        queue = self._queues.setdefault(owner, deque())
+        queue.append(future)
+        self._queued += 1
+        try:
+            if on_queued is not None:
+                # Уведомление о месте в очереди не обязательно, если его не удалось отправить, просто ждем дальше
+                try:
+                    await on_queued(self.position(owner, len(queue) - 1))
+                except Exception as e:
+                    logger.warning(f"Failed to notify about position in {self.name}: {e}")
+            await future
+        except BaseException:
+            # При любом выходе без места нужно убрать себя из очереди, иначе место достанется
+            # брошенному ожиданию и больше никогда не освободится
+            if future.done() and not future.cancelled():
+                # Место уже было отдано нам, возвращаем его следующему
+                self._release()
+            elif future in queue:
+                queue.remove(future)
+                self._queued -= 1
+                if not queue and self._queues.get(owner) is queue:
+                    del self._queues[owner]
+            raise
+
+    # Метод для передачи места следующему в очереди по кругу
+    def _release(self):
+        while self._queues:
+            owner, queue = next(iter(self._queues.items()))
+            future = queue.popleft()
+            self._queued -= 1
+            if queue:
+                # Пользователь встает в конец круга
+                self._queues.move_to_end(owner)
+            else:
+                del self._queues[owner]
+            if not future.done():
+                # Место переходит ожидающему, поэтому количество выполняющихся запросов не меняется
+                future.set_result(None)
+                return
+        self._in_flight -= 1
+
+    # Метод для вычисления позиции запроса в очереди при обходе пользователей по кругу.
+    # index - номер запроса в очереди его пользователя
+    def position(self, owner: Hashable, index: int) -> int:
+        position = 0
+        before_owner = True
+        for other, queue in self._queues.items():
+            if other == owner:
+                before_owner = False
+                position += index + 1
+                continue
+            # Пользователи перед нашим в круге успеют выполнить на один запрос больше
+            position += min(len(queue), index + 1 if before_owner else index)
+        return position
+
+    # Метод для получения метрик очереди
+    def stats(self) -> dict[str, float]:
+        return {
+            "in_flight": self._in_flight,
+            "queued": self._queued,
+            "queued_users": len(self._queues),
+        }
@@ -0,0 +1,122 @@
+# Модуль для поиска ответа на вопрос среди заранее подготовленных вопросов из template.json
+
+import os.path
+import string
+from collections import Counter
+from typing import Optional
+
+import numpy as np
+from loguru import logger
+
+from answer_cache import (
+    normalize_question,
+)
+from metrics import (
+    metrics,
+)
+from models import (
+    QuestionsFineTuningForm,
+)
+from settings import (
+    settings,
+)
+from storage import (
+    storage,
+)
+from utils import (
+    fine_tuning_form_values,
+    load_template,
+)
+
+
+# Функция для разбиения текста на символьные n-граммы, устойчивые к опечаткам и окончаниям слов
+def char_ngrams(text: str, min_n: int = 3, max_n: int = 5) -> Counter:
+    text = f" {normalize_question(text)} "
+    return Counter(text[i : i + n] for n in range(min_n, max_n + 1) for i in range(len(text) - n + 1))
+
+
+# Индекс для поиска похожего вопроса по TF-IDF символьных n-грамм и косинусной близости
+class FAQIndex:
+    def __init__(
+        self,
+        pairs: list[dict[str, str]],
+        min_score: float,
+    ):
+        self.min_score = min_score
+        self.questions = [pair["question"] for pair in pairs]
+        self.templates = [string.Template(pair["answer"]) for pair in pairs]
+        # Ответ по индексу вопроса, None если в шаблон еще нечего подставить
+        self.answers: list[Optional[str]] = [None] * len(pairs)
+
+        ngrams = [char_ngrams(question) for question in self.questions]
+        self.vocabulary = {ngram: i for i, ngram in enumerate(sorted(set().union(*ngrams)))}
+        tf = np.zeros((len(ngrams), len(self.vocabulary)), dtype=np.float32)
+        for row, counts in enumerate(ngrams):
+            for ngram, count in counts.items():
+                tf[row, self.vocabulary[ngram]] = count
+        # Сглаженный IDF, как в sklearn
+        df = np.count_nonzero(tf, axis=0)
+        self.idf = (np.log((1 + len(ngrams)) / (1 + df)) + 1).astype(np.float32)
+        self.matrix = self.normalize(np.log1p(tf) * self.idf)
+        self.update_answers(None)
+
+    # Метод для создания индекса из template.json
+    @classmethod
+    def from_template(
+        cls,
+        min_score: float,
+    ) -> "FAQIndex":
+        return cls(load_template(), min_score)
+
+    # Функция для нормализации строк матрицы по L2, чтобы скалярное произведение было косинусной близостью
+    @staticmethod
+    def normalize(matrix: np.ndarray) -> np.ndarray:
+        norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+        return matrix / np.where(norms == 0, 1, norms)
+
+    # Метод для подстановки в ответы данных из формы админки.
+    # Вопросы не меняются, поэтому матрица не пересчитывается, обновляются только ответы
+    def update_answers(self, values: Optional[dict[str, str]]):
+        answers = []
+        for template in self.templates:
+            try:
+                answers.append(template.substitute(values or {}))
+            except KeyError:
+                answers.append(None)
+        self.answers = answers
+
+    # Метод для загрузки данных формы, которые последний раз сохранили в админке
+    def load_saved_form(self):
+        if not os.path.exists(settings.fine_tuning_saved_form_data_file):
+            return
+        with open(settings.fine_tuning_saved_form_data_file, "r") as f:
+            form = QuestionsFineTuningForm.model_validate_json(f.read())
+        self.update_answers(fine_tuning_form_values(form))
+
+    # Метод для получения вектора вопроса пользователя
+    def vectorize(self, question: str) -> np.ndarray:
+        vector = np.zeros(len(self.vocabulary), dtype=np.float32)
+        for ngram, count in char_ngrams(question).items():
+            i = self.vocabulary.get(ngram)
+            if i is not None:
+                vector[i] = count
+        return self.normalize(np.log1p(vector) * self.idf)
+
+    # Метод для поиска ответа, возвращает ответ только если похожесть вопроса не меньше min_score
+    def search(self, question: str) -> Optional[str]:
+        scores = self.matrix @ self.vectorize(question)
+        best = int(np.argmax(scores))
+        answer = self.answers[best]
+        if scores[best] < self.min_score or answer is None:
+            metrics.inc("faq.misses")
+            return None
+        logger.debug(f"FAQ match {scores[best]:.2f} for question {self.questions[best]!r}")
+        metrics.inc("faq.hits")
+        return answer
+
+
+# Инициализируем инстанс индекса и подставляем сохраненные данные формы
+faq_index = FAQIndex.from_template(settings.faq_min_score)
+faq_index.load_saved_form()
+# Если форму сохранили в административной панели другого процесса, перечитываем ее из файла
+storage.subscribe("faq", lambda _: faq_index.load_saved_form())
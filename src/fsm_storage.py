@@ -0,0 +1,164 @@
+# Модуль с хранилищем состояний FSM aiogram в sqlite3.
+# Состояния переживают перезапуск и общие для всех процессов uvicorn
+
+import asyncio
+import json
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import (
+    BaseStorage,
+    StateType,
+    StorageKey,
+)
+from loguru import (
+    logger,
+)
+
+from cache import (
+    TTLCache,
+    MISSING,
+)
+from changes import (
+    ChangeLog,
+)
+from metrics import (
+    metrics,
+)
+from settings import (
+    settings,
+)
+from storage import (
+    storage,
+)
+
+
+# Хранилище FSM в базе данных с кэшем чтения в памяти процесса.
+# Чтобы кэш не отдавал устаревшие данные, когда запись изменил другой процесс, перед каждым чтением
+# проверяется PRAGMA data_version, и если база данных менялась, по журналу fsm_changes
+# из кэша выкидываются измененные ключи.
+# Записи живут ограниченное время в зависимости от состояния, а периодическая очистка
+# удаляет просроченные записи и ограничивает количество и размер всех записей
+class SQLiteStorage(BaseStorage):
+    def __init__(
+        self,
+        cache_size: int,
+        cache_ttl: float,
+        changes_keep: int,
+        compaction_interval: float,
+        max_entries: int,
+        max_bytes: int,
+    ):
+        self.changes_keep = changes_keep
+        self.compaction_interval = compaction_interval
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._compaction_task: Optional[asyncio.Task] = None
+        # Кэш записей по ключу: состояние, данные в JSON, номер изменения, после которого запись прочитана,
+        # и время изменения записи
+        self.cache = TTLCache(maxsize=cache_size, ttl=cache_ttl)
+        # Журнал изменений FSM, читается в пуле потоков хранилища
+        self.changes = ChangeLog(storage.db_path, "fsm_changes", "key")
+
+    # Функция для получения строкового ключа записи
+    @staticmethod
+    def build_key(key: StorageKey) -> str:
+        return f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id or ''}:{key.destiny}"
+
+    # Метод для удаления из кэша записей, которые изменились в базе данных после их чтения.
+    # Журнал читается в пуле потоков хранилища, чтобы не блокировать event loop
+    async def sync(self):
+        await asyncio.get_running_loop().run_in_executor(storage.executor, self.changes.read, self.apply_changes)
+
+    # Метод для применения изменений из журнала к кэшу
+    def apply_changes(self, changes: Optional[list[tuple[int, str]]]):
+        if changes is None:
+            # Часть журнала уже удалена, поэтому не знаем, что изменилось, и сбрасываем весь кэш
+            metrics.inc("fsm.cache_resets")
+            self.cache.clear()
+            return
+        for seq, key in changes:
+            cached = self.cache.get(key)
+            if cached is not MISSING and cached[2] < seq:
+                self.cache.invalidate(key)
+                metrics.inc("fsm.invalidations")
+
+    # Метод для получения записи из кэша или из базы данных.
+    # Просроченная запись считается пустой, из базы данных ее удалит очистка или следующая запись
+    async def get_record(self, key: StorageKey) -> tuple[Optional[str], str, int, int]:
+        await self.sync()
+        key = self.build_key(key)
+        record = self.cache.get(key)
+        if record is MISSING:
+            last_seq = self.changes.last_seq
+            record = await storage.get_fsm_record(key) or (None, "{}", 0, 0)
+            await self.sync()
+            # Если пока шел запрос, запись могли изменить, не кладем в кэш возможно устаревшее значение
+            if self.changes.last_seq == last_seq:
+                self.cache.set(key, record)
+        state, _, seq, updated_at = record
+        if state is not None and updated_at + settings.fsm_ttl(state) <= datetime.now().timestamp():
+            return None, "{}", seq, updated_at
+        return record
+
+    # Метод для запуска периодической очистки
+    def start(self):
+        self._compaction_task = asyncio.create_task(self.run_compaction())
+
+    # Цикл периодической очистки
+    async def run_compaction(self):
+        while True:
+            await asyncio.sleep(self.compaction_interval)
+            try:
+                await self.compact()
+            except Exception:
+                logger.exception("Failed to compact FSM storage")
+
+    # Метод для очистки просроченных и лишних записей
+    async def compact(self):
+        expired, evicted = await storage.compact_fsm(self.max_entries, self.max_bytes)
+        metrics.inc("fsm.expired", expired)
+        metrics.inc("fsm.evicted", evicted)
+        if expired or evicted:
+            logger.debug(f"FSM compaction: {expired} expired, {evicted} evicted")
+
+    # Метод для получения количества сессий в каждом состоянии
+    async def count_states(self) -> dict[str, int]:
+        return {state or "без состояния": count for state, count in (await storage.count_fsm_states()).items()}
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        state = state.state if isinstance(state, State) else state
+        key = self.build_key(key)
+        self.cache.set(key, await storage.set_fsm_state(key, state, self.changes_keep))
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        state, _, _, _ = await self.get_record(key)
+        return state
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        key = self.build_key(key)
+        self.cache.set(key, await storage.set_fsm_data(key, json.dumps(data, ensure_ascii=False), self.changes_keep))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        _, data, _, _ = await self.get_record(key)
+        # Данные хранятся в кэше в виде JSON, поэтому каждый вызов получает свою копию словаря
+        return json.loads(data)
+
+    async def close(self) -> None:
+        if self._compaction_task is not None:
+            self._compaction_task.cancel()
+            self._compaction_task = None
+        self.changes.close()
+
+
+# Инициализируем инстанс хранилища FSM
+fsm_storage = SQLiteStorage(
+    settings.fsm_cache_size,
+    settings.fsm_cache_ttl,
+    settings.fsm_changes_keep,
+    settings.fsm_compaction_interval,
+    settings.fsm_max_entries,
+    settings.fsm_max_bytes,
+)
+metrics.register_collector("fsm_cache", fsm_storage.cache.stats)
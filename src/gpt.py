@@ -1,9 +1,26 @@
 # Модуль для работы с LLM yandex cloud
-import httpx
+import asyncio
+import json
+from typing import AsyncIterator, Awaitable, Callable, Hashable, Optional
 
+from answer_cache import (
+    answer_cache,
+)
+from fair_queue import (
+    FairScheduler,
+)
+from http_clients import (
+    http_clients,
+)
 from settings import (
     settings,
 )
+from singleflight import (
+    SingleFlight,
+)
+from upstream import (
+    Upstream,
+)
 
 
 class LLM:
@@ -12,17 +29,91 @@ class LLM:
     ):
         self.yc_uri = "https://llm.api.cloud.yandex.net/foundationModels/v1/completion"
 
-    # Метод для того чтобы спросить вопрос у LLM
+    # Метод для того чтобы спросить вопрос у LLM, повторные вопросы отвечаются из кэша.
+    # owner - пользователь, от имени которого задается вопрос, нужен для честной очереди.
+    # Одинаковые одновременные вопросы объединяются в один запрос к yandex cloud
     async def ask(
         self,
         question: str,
+        owner: Hashable = None,
+        on_queued: Optional[Callable[[int], Awaitable]] = None,
+    ) -> str:
+        answer = await answer_cache.get(question)
+        if answer is not None:
+            return answer
+        return await llm_flights.do(answer_cache.key(question), lambda: self.ask_upstream(question, owner, on_queued))
+
+    # Метод для запроса в yandex cloud с ожиданием места в очереди и сохранением ответа в кэш
+    async def ask_upstream(
+        self,
+        question: str,
+        owner: Hashable,
+        on_queued: Optional[Callable[[int], Awaitable]],
     ) -> str:
-        d = {
+        async with llm_scheduler.slot(owner, on_queued):
+            answer = await llm_upstream.call(lambda: self.request(question))
+        await answer_cache.set(question, answer)
+        return answer
+
+    # Метод для того чтобы спросить вопрос у LLM и получать ответ по мере генерации.
+    # Каждое значение - это весь текст ответа, сгенерированный к текущему моменту.
+    # Если такой же вопрос уже задается, ответ придет целиком, когда закончится тот запрос
+    async def ask_stream(
+        self,
+        question: str,
+        owner: Hashable = None,
+        on_queued: Optional[Callable[[int], Awaitable]] = None,
+    ) -> AsyncIterator[str]:
+        answer = await answer_cache.get(question)
+        if answer is not None:
+            yield answer
+            return
+        partials: asyncio.Queue[Optional[str]] = asyncio.Queue()
+        key = answer_cache.key(question)
+        task, is_leader = llm_flights.start(
+            key,
+            lambda: self.ask_upstream_stream(question, owner, on_queued, partials),
+        )
+        try:
+            if is_leader:
+                # Пока запрос идет, отдаем части ответа из очереди, None означает конец ответа
+                while (answer := await partials.get()) is not None:
+                    yield answer
+            yield await asyncio.shield(task)
+        finally:
+            llm_flights.release(key, task)
+
+    # Метод для потокового запроса в yandex cloud, части ответа складываются в очередь partials
+    async def ask_upstream_stream(
+        self,
+        question: str,
+        owner: Hashable,
+        on_queued: Optional[Callable[[int], Awaitable]],
+        partials: asyncio.Queue[Optional[str]],
+    ) -> str:
+        answer = ""
+        try:
+            async with llm_scheduler.slot(owner, on_queued):
+                async for answer in llm_upstream.stream(lambda: self.request_stream(question)):
+                    partials.put_nowait(answer)
+        finally:
+            partials.put_nowait(None)
+        if answer:
+            await answer_cache.set(question, answer)
+        return answer
+
+    # Метод для формирования тела запроса в yandex cloud
+    @staticmethod
+    def build_request(
+        question: str,
+        stream: bool,
+    ) -> dict:
+        return {
             # URI модели yandex cloud
             "modelUri": settings.yandex_model_uri,
             "completionOptions": {
-                # Указываем что нам надо сразу получить ответ
-                "stream": False,
+                # Указываем нужно ли получать ответ по частям или сразу целиком
+                "stream": stream,
                 # Указываем температуру ответа
                 "temperature": settings.temperature_model,
                 # Указываем максимальное количество токенов
@@ -36,20 +127,56 @@ class LLM:
                 }
             ],
         }
-        async with httpx.AsyncClient(timeout=60) as client:
-            r = await client.post(
-                self.yc_uri,
-                json=d,
-                headers={
-                    # Указываем в хедерах токен
-                    "Authorization": f"Bearer {settings.token}",
-                    # Указываем yandex cloud папку
-                    "x-folder-id": settings.folder_id,
-                },
-            )
+
+    # Метод для формирования заголовков запроса в yandex cloud
+    @staticmethod
+    def build_headers() -> dict[str, str]:
+        return {
+            # Указываем в хедерах токен
+            "Authorization": f"Bearer {settings.token}",
+            # Указываем yandex cloud папку
+            "x-folder-id": settings.folder_id,
+        }
+
+    # Метод для отправки вопроса в yandex cloud
+    async def request(
+        self,
+        question: str,
+    ) -> str:
+        r = await http_clients.client.post(
+            self.yc_uri,
+            json=self.build_request(question, stream=False),
+            headers=self.build_headers(),
+            timeout=http_clients.llm_timeout,
+        )
+        r.raise_for_status()
+        # Достаем ответ
+        return r.json()["result"]["alternatives"][0]["message"]["text"]
+
+    # Метод для отправки вопроса в yandex cloud с потоковым получением ответа.
+    # Yandex присылает по строке JSON на каждую часть, в каждой строке весь текст ответа на текущий момент
+    async def request_stream(
+        self,
+        question: str,
+    ) -> AsyncIterator[str]:
+        async with http_clients.client.stream(
+            "POST",
+            self.yc_uri,
+            json=self.build_request(question, stream=True),
+            headers=self.build_headers(),
+            timeout=http_clients.llm_timeout,
+        ) as r:
             r.raise_for_status()
-            # Достаем ответ
-            return r.json()["result"]["alternatives"][0]["message"]["text"]
+            async for line in r.aiter_lines():
+                if not line.strip():
+                    continue
+                yield json.loads(line)["result"]["alternatives"][0]["message"]["text"]
 
 
+# Инициализируем планировщик, который ограничивает количество одновременных запросов к LLM
+llm_scheduler = FairScheduler("llm_scheduler", settings.llm_max_in_flight, settings.llm_max_queue)
+# Инициализируем объединение одинаковых одновременных вопросов
+llm_flights = SingleFlight("llm_flights")
+# Инициализируем устойчивые вызовы LLM
+llm_upstream = Upstream("llm")
 llm = LLM()
@@ -1,9 +1,13 @@
 # Модуль отвечает за работу административной панели
 
+import asyncio
 import json
 import os.path
+import time
+from datetime import datetime
 from typing import (
     Annotated,
+    AsyncIterator,
 )
 
 from fastui.components.display import DisplayMode
@@ -17,14 +21,19 @@ from fastapi import (
     Depends,
     Query,
 )
-from fastapi.responses import HTMLResponse, FileResponse
+from fastapi.responses import HTMLResponse, FileResponse, StreamingResponse
 
-from handlers.dependencies import auth_api_dependence
-from models import User, QuestionsFineTuningForm, UpdateSettingsForm
+from answer_cache import answer_cache
+from broadcast import broadcaster
+from handlers.dependencies import auth_api_dependence, auth_query_dependence
+from metrics import metrics
+from models import User, QuestionsFineTuningForm, UpdateSettingsForm, Metric, Broadcast, BroadcastForm
 from storage import (
     storage,
 )
-from utils import gen_fine_tuning_file
+from faq import faq_index
+from fsm_storage import fsm_storage
+from utils import gen_fine_tuning_file, fine_tuning_form_values
 from settings import settings
 
 router = APIRouter()
@@ -57,6 +66,16 @@ def base_page(
                     on_click=e.GoToEvent(url="/settings"),
                     active="startswith:/settings",
                 ),
+                c.Link(
+                    components=[c.Text(text="Рассылки")],
+                    on_click=e.GoToEvent(url="/broadcasts"),
+                    active="startswith:/broadcasts",
+                ),
+                c.Link(
+                    components=[c.Text(text="Метрики")],
+                    on_click=e.GoToEvent(url="/metrics"),
+                    active="startswith:/metrics",
+                ),
             ],
             end_links=[c.Link(components=[c.Text(text="Выйти")], on_click=e.GoToEvent(url="/logout"))],
         ),
@@ -78,10 +97,10 @@ def index_api() -> list[c.AnyComponent]:
 
 # Функция для работы с аутентификацией
 @router.get("/api/auth", response_model=FastUI, response_model_exclude_none=True)
-def auth_api(token: Annotated[str | None, Query()] = None) -> list[c.AnyComponent]:
+async def auth_api(token: Annotated[str | None, Query()] = None) -> list[c.AnyComponent]:
     if token is None:
         raise HTTPException(status_code=403, detail="Unauthorized")
-    is_valid = storage.is_token_valid(token)
+    is_valid = await storage.is_token_valid(token)
     if not is_valid:
         raise HTTPException(status_code=403, detail="Unauthorized")
     return [c.FireEvent(event=e.AuthEvent(token=token, url="/"))]
@@ -89,8 +108,8 @@ def auth_api(token: Annotated[str | None, Query()] = None) -> list[c.AnyComponen
 
 # Функция для очистки аутентификации
 @router.get("/api/logout", response_model=FastUI, response_model_exclude_none=True)
-def logout_api(token: str = Depends(auth_api_dependence)) -> list[c.AnyComponent]:
-    storage.delete_token(token)
+async def logout_api(token: str = Depends(auth_api_dependence)) -> list[c.AnyComponent]:
+    await storage.delete_token(token)
     return [c.FireEvent(event=e.AuthEvent(token=False, url="/"))]
 
 
@@ -98,14 +117,14 @@ def logout_api(token: str = Depends(auth_api_dependence)) -> list[c.AnyComponent
 @router.get(
     "/api/users", response_model=FastUI, response_model_exclude_none=True, dependencies=[Depends(auth_api_dependence)]
 )
-def users_api(
+async def users_api(
     page: int = 1,
 ) -> list[c.AnyComponent]:
     page_size = 10
-    count = storage.count_all_users()
+    count = await storage.count_all_users()
     return base_page(
         c.Table(
-            data=storage.list_all_users(),
+            data=await storage.list_users_page(page, page_size),
             data_model=User,
             columns=[
                 c.display.DisplayLookup(field="id", title="Идентификатор пользователя", mode=DisplayMode.plain),
@@ -154,18 +173,184 @@ def settings_api() -> list[c.AnyComponent]:
     response_model_exclude_none=True,
     dependencies=[Depends(auth_api_dependence)],
 )
-def settings_update_api(
+async def settings_update_api(
     form: Annotated[
         UpdateSettingsForm,
         fastui_form(UpdateSettingsForm),
     ]
 ) -> list[c.AnyComponent]:
+    # Ответы другой модели или с другой температурой больше не актуальны
+    if (form.yandex_model_uri, float(form.temperature_model)) != (
+        settings.yandex_model_uri,
+        settings.temperature_model,
+    ):
+        await answer_cache.clear()
     settings.yandex_model_uri = form.yandex_model_uri
     settings.temperature_model = float(form.temperature_model)
     settings.dump_to_self_file()
+    # Остальные процессы перечитают настройки из файла по журналу изменений
+    await storage.notify_change("settings")
     return [c.FireEvent(event=e.GoToEvent(url="/settings"))]
 
 
+# Функция для показа метрик приложения
+@router.get(
+    "/api/metrics",
+    response_model=FastUI,
+    response_model_exclude_none=True,
+    dependencies=[Depends(auth_api_dependence)],
+)
+async def metrics_api() -> list[c.AnyComponent]:
+    states = await fsm_storage.count_states()
+    return base_page(
+        c.Heading(text="Сессии по состояниям", level=3),
+        c.Table(
+            data=[Metric(name=state, value=str(count)) for state, count in states.items()],
+            data_model=Metric,
+            columns=[
+                c.display.DisplayLookup(field="name", title="Состояние", mode=DisplayMode.plain),
+                c.display.DisplayLookup(field="value", title="Сессий", mode=DisplayMode.plain),
+            ],
+            no_data_message="Сессий нет",
+        ),
+        c.Heading(text="Метрики", level=3),
+        c.Table(
+            data=[
+                Metric(name=name, value=f"{value:.3f}" if isinstance(value, float) else str(value))
+                for name, value in metrics.snapshot().items()
+            ],
+            data_model=Metric,
+            columns=[
+                c.display.DisplayLookup(field="name", title="Метрика", mode=DisplayMode.plain),
+                c.display.DisplayLookup(field="value", title="Значение", mode=DisplayMode.plain),
+            ],
+            no_data_message="Метрик нет",
+        ),
+    )
+
+
+# Функция для показа формы рассылки и последних рассылок
+@router.get(
+    "/api/broadcasts",
+    response_model=FastUI,
+    response_model_exclude_none=True,
+    dependencies=[Depends(auth_api_dependence)],
+)
+async def broadcasts_api() -> list[c.AnyComponent]:
+    return base_page(
+        c.ModelForm(model=BroadcastForm, submit_url="/api/broadcasts"),
+        c.Heading(text="Последние рассылки", level=3),
+        c.Table(
+            data=await storage.list_broadcasts(20),
+            data_model=Broadcast,
+            columns=[
+                c.display.DisplayLookup(
+                    field="id", title="Идентификатор рассылки", on_click=e.GoToEvent(url="/broadcasts/{id}")
+                ),
+                c.display.DisplayLookup(field="status", title="Статус", mode=DisplayMode.plain),
+                c.display.DisplayLookup(field="total", title="Получателей", mode=DisplayMode.plain),
+                c.display.DisplayLookup(field="sent", title="Отправлено", mode=DisplayMode.plain),
+                c.display.DisplayLookup(field="failed", title="Не доставлено", mode=DisplayMode.plain),
+                c.display.DisplayLookup(field="text", title="Текст", mode=DisplayMode.plain),
+            ],
+            no_data_message="Рассылок нет",
+        ),
+    )
+
+
+# Функция для запуска рассылки
+@router.post(
+    "/api/broadcasts",
+    response_model=FastUI,
+    response_model_exclude_none=True,
+    dependencies=[Depends(auth_api_dependence)],
+)
+async def broadcast_create_api(
+    form: Annotated[
+        BroadcastForm,
+        fastui_form(BroadcastForm),
+    ]
+) -> list[c.AnyComponent]:
+    broadcast = await broadcaster.start_broadcast(form.text)
+    return [c.FireEvent(event=e.GoToEvent(url=f"/broadcasts/{broadcast.id}"))]
+
+
+# Функция для получения компонентов с прогрессом рассылки.
+# processed и elapsed - сколько сообщений обработано за elapsed секунд, по ним считается скорость
+def broadcast_progress(
+    broadcast: Broadcast,
+    processed: int,
+    elapsed: float,
+) -> list[c.AnyComponent]:
+    done = broadcast.sent + broadcast.failed
+    rows = [
+        ("Статус", broadcast.status),
+        ("Получателей", str(broadcast.total)),
+        ("Отправлено", str(broadcast.sent)),
+        ("Не доставлено", str(broadcast.failed)),
+        ("Готово", f"{done / broadcast.total:.0%}" if broadcast.total else "100%"),
+        ("Скорость, сообщений в секунду", f"{processed / elapsed:.1f}" if elapsed > 0 else "0.0"),
+    ]
+    if broadcast.finished_at is not None:
+        rows.append(("Завершена", str(datetime.fromtimestamp(broadcast.finished_at))))
+    return [
+        c.Table(
+            data=[Metric(name=name, value=value) for name, value in rows],
+            data_model=Metric,
+            columns=[
+                c.display.DisplayLookup(field="name", title="Показатель", mode=DisplayMode.plain),
+                c.display.DisplayLookup(field="value", title="Значение", mode=DisplayMode.plain),
+            ],
+        )
+    ]
+
+
+# Функция для показа страницы рассылки. Пока рассылка идет, прогресс обновляется через SSE
+@router.get(
+    "/api/broadcasts/{broadcast_id}",
+    response_model=FastUI,
+    response_model_exclude_none=True,
+)
+async def broadcast_api(
+    broadcast_id: int,
+    token: str = Depends(auth_api_dependence),
+) -> list[c.AnyComponent]:
+    broadcast = await storage.get_broadcast(broadcast_id)
+    if broadcast is None:
+        raise HTTPException(status_code=404, detail="Broadcast not found")
+    if broadcast.status == "running":
+        progress = c.ServerLoad(path=f"/broadcasts/{broadcast_id}/progress?token={token}", sse=True)
+    else:
+        progress = c.Div(components=broadcast_progress(broadcast, 0, 0))
+    return base_page(
+        c.Heading(text=f"Рассылка {broadcast_id}", level=2),
+        c.Paragraph(text=broadcast.text),
+        progress,
+    )
+
+
+# Функция для отправки прогресса рассылки через SSE раз в секунду, пока рассылка не закончится
+@router.get("/api/broadcasts/{broadcast_id}/progress", dependencies=[Depends(auth_query_dependence)])
+async def broadcast_progress_sse(broadcast_id: int) -> StreamingResponse:
+    async def stream() -> AsyncIterator[str]:
+        started = time.monotonic()
+        initial = None
+        while True:
+            broadcast = await storage.get_broadcast(broadcast_id)
+            if broadcast is None:
+                return
+            done = broadcast.sent + broadcast.failed
+            if initial is None:
+                initial = done
+            components = FastUI(root=broadcast_progress(broadcast, done - initial, time.monotonic() - started))
+            yield f"data: {components.model_dump_json(by_alias=True, exclude_none=True)}\n\n"
+            if broadcast.status != "running":
+                return
+            await asyncio.sleep(1)
+
+    return StreamingResponse(stream(), media_type="text/event-stream")
+
+
 # Функция для получения компонентов страницы с обучением модели
 @router.get(
     "/api/fine-tuning",
@@ -185,22 +370,26 @@ def fine_tuning_api() -> list[c.AnyComponent]:
 
 # Функция для сохранения и генерации файла для обучения модели
 @router.post("/api/fine-tuning", dependencies=[Depends(auth_api_dependence)])
-def fine_tuning_gen_file(
+async def fine_tuning_gen_file(
     form: Annotated[
         QuestionsFineTuningForm,
         fastui_form(QuestionsFineTuningForm),
     ]
 ) -> list[c.AnyComponent]:
-    file = gen_fine_tuning_file(form)
+    file = await gen_fine_tuning_file(form)
     with open(settings.fine_tuning_saved_form_data_file, "w") as f:
         f.write(form.model_dump_json())
+    # Обновляем ответы в индексе часто задаваемых вопросов
+    faq_index.update_answers(fine_tuning_form_values(form))
+    # Остальные процессы перечитают форму из файла по журналу изменений
+    await storage.notify_change("faq")
     return [c.FireEvent(event=e.GoToEvent(url=f"/api/download-file?file_id={file.id}", target="_blank"))]
 
 
 # Функция для скачивания файла
 @router.get("/api/download-file")
-def download_file(file_id: int) -> FileResponse:
-    file = storage.get_file_by_id(file_id)
+async def download_file(file_id: int) -> FileResponse:
+    file = await storage.get_file_by_id(file_id)
     if file is None:
         raise HTTPException(status_code=404, detail="File not exists or not valid")
     return FileResponse(path=file.path_to_file, media_type=file.file_mime_type, filename=file.file_name)
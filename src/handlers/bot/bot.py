@@ -1,5 +1,4 @@
 import datetime
-import tempfile
 import uuid
 from typing import Optional, Union
 
@@ -16,16 +15,24 @@ from aiogram.fsm.context import (
 )
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 
-from handlers.bot.utils import create_start_kb
+import exceptions
+from faq import faq_index
+from handlers.bot.utils import create_start_kb, answer_with_stream, download_voice, EMPTY_ANSWER_TEXT
 from models import User
 from recognizer import recognizer
 from settings import settings
 from storage import (
     storage,
 )
+from transcription_cache import (
+    transcription_cache,
+)
 from gpt import (
     llm,
 )
+from supersede import (
+    llm_questions,
+)
 
 
 class UserState(StatesGroup):
@@ -68,7 +75,7 @@ async def answer_choose_city_handler(message: types.Message, state: FSMContext,
         message.answer("Вы не ввели текстовое сообщение")
         return
     if user is not None:
-        storage.update_tg_user_city(message.from_user.id, message.text)
+        await storage.update_tg_user_city(message.from_user.id, message.text)
         await message.answer("Вы сменили свой город.")
         await state.clear()
         return
@@ -91,7 +98,7 @@ async def answer_type_phone_handler(message: types.Message, state: FSMContext, u
         await message.answer("Вы неправильно ввели номер телефона, пожалуйста, введите его в формате +71234567890")
         return
     if user is not None:
-        storage.update_tg_user_phone(message.from_user.id, phone)
+        await storage.update_tg_user_phone(message.from_user.id, phone)
         await message.answer("Вы сменили свой телефон")
         await state.clear()
         return
@@ -115,7 +122,7 @@ async def answer_type_email_handler(message: types.Message, state: FSMContext, u
         await message.answer("Вы неправильно ввели свой email. Формат example@example.com")
         return
     if user is not None:
-        storage.update_tg_user_email(message.from_user.id, message.text)
+        await storage.update_tg_user_email(message.from_user.id, message.text)
         await message.answer("Вы сменили свой email")
         await state.clear()
         return
@@ -133,7 +140,7 @@ async def answer_type_first_name_handler(message: types.Message, state: FSMConte
         message.answer("Вы не ввели текстовое сообщение")
         return
     if user is not None:
-        storage.update_tg_user_first_name(message.from_user.id, message.text)
+        await storage.update_tg_user_first_name(message.from_user.id, message.text)
         await message.answer("Вы сменили свой имя.")
         await state.clear()
         return
@@ -151,13 +158,13 @@ async def answer_type_last_name_handler(message: types.Message, state: FSMContex
         message.answer("Вы не ввели текстовое сообщение")
         return
     if user is not None:
-        storage.update_tg_user_last_name(message.from_user.id, message.text)
+        await storage.update_tg_user_last_name(message.from_user.id, message.text)
         await message.answer("Вы сменили свою фамилию.")
         await state.clear()
         return
     data = await state.get_data()
     # Создаем пользователя в бд
-    storage.create_tg_user(
+    await storage.create_tg_user(
         message.from_user.id,
         data["city"],
         data["phone"],
@@ -173,8 +180,8 @@ async def answer_type_last_name_handler(message: types.Message, state: FSMContex
 
 
 # Обрабатываем случай когда пользователя хочет что то спросить
-@router.message(Command("ask"))
-@router.callback_query(lambda query: query.data == "ask")
+@router.message(Command("ask"), flags={"rate_limit": True})
+@router.callback_query(lambda query: query.data == "ask", flags={"rate_limit": True})
 async def ask_llm(
     message: Union[types.Message, types.CallbackQuery],
     state: FSMContext,
@@ -187,30 +194,75 @@ async def ask_llm(
 
 
 # Получаем вопрос от пользователя
-@router.message(UserState.wait_for_llm_question)
+@router.message(UserState.wait_for_llm_question, flags={"rate_limit": True})
 async def answer_question_with_llm(
     message: types.Message,
     state: FSMContext,
+):
+    # Новый вопрос пользователя отменяет его предыдущий вопрос, на который ответ еще не пришел
+    await llm_questions.run(message.chat.id, message.message_id, lambda: answer_question(message, state))
+
+
+# Функция для распознавания вопроса пользователя и ответа на него
+async def answer_question(
+    message: types.Message,
+    state: FSMContext,
 ):
     if message.voice is not None:
-        if message.voice.duration > 10:
-            await message.answer("Слишком длинный вопрос :( . Максимальная длина 10 секунд")
+        if message.voice.duration > settings.voice_max_duration:
+            await message.answer(f"Слишком длинный вопрос :( . Максимальная длина {settings.voice_max_duration} секунд")
             return
         # Trying to translate audio to text
-        # Пробуем дешифровать голсовое сообщения пользователя если он его отправил
-        with tempfile.NamedTemporaryFile(suffix=".ogg", delete=False) as file:
-            await message.bot.download(message.voice.file_id, file.name)
-            text = await recognizer.recognize(file.name, format_audio="oggopus")
-            await message.answer("Распознанный текст:\n{}".format(text))
+        # Пробуем дешифровать голсовое сообщения пользователя если он его отправил.
+        # Если это голосовое уже распознавалось, берем текст из кэша без скачивания и распознавания
+        text = await transcription_cache.get(message.voice.file_unique_id)
+        if text is None:
+            # Голос скачивается в память и сразу отправляется на распознавание
+            try:
+                content = await download_voice(message, settings.voice_max_bytes)
+            except exceptions.VoiceTooLargeException:
+                await message.answer("Слишком большое голосовое сообщение :(")
+                return
+            text = await recognizer.recognize(content, format_audio="oggopus")
+            if text:
+                await transcription_cache.set(message.voice.file_unique_id, text)
+        await message.answer("Распознанный текст:\n{}".format(text))
     elif message.text is not None:
         text = message.text
     else:
         message.answer("Вы отправили ни текстовое, ни голосовое сообщение")
         return
+    # Если вопрос похож на один из заранее подготовленных, отвечаем без обращения к LLM
+    answer = faq_index.search(text)
+    if answer is not None:
+        await message.answer(answer)
+        await finish_question(state)
+        return
+
     # Получаем ответ от YandexGPT и отправляем его пользователю
-    answer = await llm.ask(text)
-    await message.answer(answer)
-    await state.clear()
+    # Сообщаем пользователю его место в очереди, если LLM сейчас занята
+    async def on_queued(position: int):
+        await message.answer(f"Вы в очереди, позиция {position}. Ответ придет, как только подойдет ваша очередь")
+
+    if settings.llm_streaming:
+        # Отправляем ответ по мере генерации, редактируя одно сообщение
+        await answer_with_stream(
+            message,
+            llm.ask_stream(text, message.from_user.id, on_queued),
+            settings.llm_stream_edit_interval,
+        )
+    else:
+        answer = await llm.ask(text, message.from_user.id, on_queued)
+        await message.answer(answer if answer.strip() else EMPTY_ANSWER_TEXT)
+    await finish_question(state)
+
+
+# Функция для выхода из ожидания вопроса после ответа. Обновления, которые не относятся к вопросам,
+# обрабатываются параллельно с ответом, и пользователь мог уже перейти в другое состояние,
+# например начать менять город. Такое состояние не сбрасываем
+async def finish_question(state: FSMContext):
+    if await state.get_state() == UserState.wait_for_llm_question.state:
+        await state.clear()
 
 
 # Обрабатываем случай вызова настроек от пользователя
@@ -273,7 +325,7 @@ async def admin(message: Union[types.Message, types.CallbackQuery]):
 
     # Add 1 hour to current time, so token will be valid for 1 hour
     # Создаем токен для пользователя
-    token = storage.insert_token(str(uuid.uuid4()), int(datetime.datetime.now().timestamp() + 3600))
+    token = await storage.insert_token(str(uuid.uuid4()), int(datetime.datetime.now().timestamp() + 3600))
 
     kb = InlineKeyboardMarkup(
         inline_keyboard=[
@@ -1,5 +1,15 @@
+import io
+import time
+from typing import AsyncIterator
+
+from aiogram import types
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 
+import exceptions
+
+# Текст, который отправляется, если LLM вернула пустой ответ. Телеграмм не принимает пустые сообщения
+EMPTY_ANSWER_TEXT = "Не удалось получить ответ на вопрос, попробуйте его переформулировать"
+
 
 # Функция для создания стартовой клавиатуры
 def create_start_kb(show_admin_buttons: bool = False) -> InlineKeyboardMarkup:
@@ -18,3 +28,50 @@ def create_start_kb(show_admin_buttons: bool = False) -> InlineKeyboardMarkup:
     if show_admin_buttons:
         kb.inline_keyboard.append([InlineKeyboardButton(text="Административная панель", callback_data="admin_panel")])
     return kb
+
+
+# Функция для отправки ответа, который генерируется по частям.
+# Отправляем одно сообщение и редактируем его не чаще чем раз в interval секунд
+async def answer_with_stream(message: types.Message, chunks: AsyncIterator[str], interval: float) -> str:
+    sent: types.Message | None = None
+    sent_text = ""
+    last_edit = 0.0
+    text = ""
+    async for text in chunks:
+        if not text.strip() or text == sent_text:
+            continue
+        if sent is None:
+            sent = await message.answer(text)
+        elif time.monotonic() - last_edit >= interval:
+            await sent.edit_text(text)
+        else:
+            continue
+        sent_text = text
+        last_edit = time.monotonic()
+    # Отправляем финальный текст, если последние части не попали в сообщение из-за ограничения частоты
+    if sent is None:
+        await message.answer(text if text.strip() else EMPTY_ANSWER_TEXT)
+    elif text.strip() and text != sent_text:
+        await sent.edit_text(text)
+    return text
+
+
+# Буфер в памяти с ограничением размера, чтобы одно голосовое сообщение не заняло больше памяти чем разрешено
+class CappedBuffer(io.BytesIO):
+    def __init__(self, cap: int):
+        super().__init__()
+        self.cap = cap
+
+    def write(self, data: bytes) -> int:
+        if self.tell() + len(data) > self.cap:
+            raise exceptions.VoiceTooLargeException()
+        return super().write(data)
+
+
+# Функция для скачивания голосового сообщения сразу в память, без временных файлов на диске
+async def download_voice(message: types.Message, cap: int) -> bytes:
+    if message.voice.file_size is not None and message.voice.file_size > cap:
+        raise exceptions.VoiceTooLargeException()
+    buffer = CappedBuffer(cap)
+    await message.bot.download(message.voice.file_id, destination=buffer)
+    return buffer.getvalue()
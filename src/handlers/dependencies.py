@@ -1,15 +1,22 @@
 from typing import Annotated
 
-from fastapi import Header, HTTPException
+from fastapi import Header, HTTPException, Query
 
 from storage import storage
 
 
-def auth_api_dependence(authorization: Annotated[str | None, Header()] = None) -> str:
+async def auth_api_dependence(authorization: Annotated[str | None, Header()] = None) -> str:
     if authorization is None:
         raise HTTPException(status_code=403, detail="Unauthorized")
     token = authorization.split(" ")[1]
-    is_valid = storage.is_token_valid(token)
+    is_valid = await storage.is_token_valid(token)
     if not is_valid:
         raise HTTPException(status_code=403, detail="Unauthorized")
     return token
+
+
+# Проверка токена из параметра запроса, нужна для SSE: браузерный EventSource не умеет передавать заголовки
+async def auth_query_dependence(token: Annotated[str | None, Query()] = None) -> str:
+    if token is None or not await storage.is_token_valid(token):
+        raise HTTPException(status_code=403, detail="Unauthorized")
+    return token
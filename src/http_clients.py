@@ -0,0 +1,82 @@
+# Модуль с общим HTTP клиентом для запросов в yandex cloud.
+# Клиент живет все время работы приложения, поэтому соединения переиспользуются между запросами
+
+from typing import Any, Optional
+
+import httpx
+
+from metrics import (
+    metrics,
+)
+from settings import (
+    settings,
+)
+
+
+class HTTPClients:
+    def __init__(
+        self,
+    ):
+        self._client: Optional[httpx.AsyncClient] = None
+        # Таймауты для каждого из сервисов yandex cloud
+        self.llm_timeout = httpx.Timeout(settings.llm_timeout, connect=settings.http_connect_timeout)
+        self.stt_timeout = httpx.Timeout(settings.stt_timeout, connect=settings.http_connect_timeout)
+        self.iam_timeout = httpx.Timeout(settings.iam_timeout, connect=settings.http_connect_timeout)
+
+    # Клиент для запросов, доступен только между start и close
+    @property
+    def client(
+        self,
+    ) -> httpx.AsyncClient:
+        if self._client is None:
+            raise RuntimeError("HTTP client is not started")
+        return self._client
+
+    # Метод для создания пула соединений, вызывается при старте приложения
+    async def start(
+        self,
+    ):
+        self._client = httpx.AsyncClient(
+            # HTTP/2 позволяет отправлять несколько запросов по одному соединению
+            http2=True,
+            limits=httpx.Limits(
+                max_connections=settings.http_max_connections,
+                max_keepalive_connections=settings.http_max_keepalive_connections,
+                keepalive_expiry=settings.http_keepalive_expiry,
+            ),
+            event_hooks={"request": [self.on_request]},
+        )
+
+    # Метод для закрытия всех соединений, вызывается при остановке приложения
+    async def close(
+        self,
+    ):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    # Хук, который вызывается перед каждым запросом, подключает трассировку соединений
+    async def on_request(self, request: httpx.Request):
+        metrics.inc("http.requests")
+        request.extensions["trace"] = self.trace
+
+    # Обработчик событий трассировки httpcore, считаем сколько было открыто новых соединений
+    @staticmethod
+    async def trace(event_name: str, info: dict[str, Any]):
+        if event_name == "connection.connect_tcp.complete":
+            metrics.inc("http.new_connections")
+
+    # Метод для получения метрик переиспользования соединений
+    @staticmethod
+    def stats() -> dict[str, float]:
+        requests = metrics.get("http.requests")
+        new_connections = metrics.get("http.new_connections")
+        return {
+            "reused_connections": max(requests - new_connections, 0),
+            "reuse_ratio": 1 - new_connections / requests if requests else 0.0,
+        }
+
+
+# Инициализируем инстанс общего HTTP клиента
+http_clients = HTTPClients()
+metrics.register_collector("http", http_clients.stats)
@@ -4,12 +4,16 @@ from contextlib import (
     asynccontextmanager,
 )
 
-from fastapi import FastAPI
+from aiogram.types import Update
+from fastapi import FastAPI, HTTPException, Request, Response
+from pydantic import ValidationError
 
 from bot import (
     start_telegram,
-    dp,
     bot,
+    updates_pools,
+    route_update,
+    recent_updates,
 )
 from settings import (
     settings,
@@ -18,6 +22,9 @@ from handlers.admin import (
     router as admin_router,
 )
 from storage import storage
+from fsm_storage import fsm_storage
+from broadcast import broadcaster
+from http_clients import http_clients
 
 
 # Функция для жизненного цикла веб сервера
@@ -25,6 +32,11 @@ from storage import storage
 async def lifespan(
     _: FastAPI,
 ):
+    # Создаем общий пул соединений для запросов в yandex cloud
+    await http_clients.start()
+    # Запускаем воркеры, которые обрабатывают обновления из телеграмма
+    for pool in updates_pools:
+        pool.start()
     # Стартуем телеграмм
     await start_telegram()
 
@@ -34,11 +46,21 @@ async def lifespan(
         raise RuntimeError("Cant set yc_token, error: {}".format(response.text))
     # Запускаем задачу на обновление yandex cloud token
     asyncio.create_task(settings.loop_update_yc_token())
-    # Запускаем задачу на удаление старых токенов
-    asyncio.create_task(storage.loop_delete_old_tokens())
-    # Запускаем задачу на удаление старых файлов
-    asyncio.create_task(storage.loop_delete_old_files())
+    # Запускаем планировщик удаления старых токенов и файлов
+    await storage.start()
+    # Запускаем периодическую очистку состояний FSM
+    fsm_storage.start()
+    # Продолжаем рассылки, которые не успели закончиться до перезапуска
+    broadcaster.start()
     yield
+    # Даем обработаться обновлениям, которые уже приняты
+    await asyncio.gather(*(pool.stop(settings.webhook_shutdown_timeout) for pool in updates_pools))
+    await broadcaster.close()
+    await fsm_storage.close()
+    # Дожидаемся завершения запросов к базе данных и закрываем подключения
+    await storage.close()
+    # Закрываем соединения с yandex cloud
+    await http_clients.close()
 
 
 # Инициализируем инстанс нашего сервера
@@ -50,12 +72,31 @@ app = FastAPI(
 app.include_router(admin_router)
 
 
-# Добавляем обработчик нашего вебхука
+# Добавляем обработчик нашего вебхука.
+# Обновление только ставится в очередь, поэтому телеграмм получает ответ сразу,
+# не дожидаясь ответа LLM или распознавания голоса.
+# Тело запроса читается как есть и разбирается сразу в модель Update парсером pydantic,
+# без промежуточного словаря, который FastAPI собирал бы через json.loads
 @app.post(settings.webhook_path)
 async def tg_webhook(
-    update: dict,
+    request: Request,
+    response: Response,
 ):
-    await dp.feed_webhook_update(
-        bot=bot,
-        update=update,
-    )
+    try:
+        update = Update.model_validate_json(await request.body(), context={"bot": bot})
+    except ValidationError:
+        raise HTTPException(status_code=400, detail="Invalid update")
+    # Повторно доставленное обновление уже принято этим или другим процессом, просто подтверждаем его
+    if not await recent_updates.claim(update.update_id):
+        return
+    try:
+        pool, key = await route_update(update)
+        accepted = pool.submit(key, update)
+    except BaseException:
+        await recent_updates.release(update.update_id)
+        raise
+    if not accepted:
+        # Очередь переполнена, телеграмм повторит доставку обновления позже
+        await recent_updates.release(update.update_id)
+        response.status_code = 503
+        return
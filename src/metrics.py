@@ -0,0 +1,96 @@
+# Модуль для сбора метрик приложения, метрики показываются в административной панели
+
+import threading
+from collections import deque
+from typing import Callable
+
+
+# Гистограмма по последним наблюдениям, позволяет считать перцентили без хранения всей истории
+class Histogram:
+    def __init__(
+        self,
+        size: int = 1000,
+    ):
+        self._samples: deque[float] = deque(maxlen=size)
+        self.count = 0
+        self.total = 0.0
+
+    # Метод для добавления наблюдения
+    def observe(self, value: float):
+        self._samples.append(value)
+        self.count += 1
+        self.total += value
+
+    # Метод для получения перцентиля по последним наблюдениям, q от 0 до 1
+    def percentile(self, q: float) -> float:
+        if not self._samples:
+            return 0.0
+        samples = sorted(self._samples)
+        return samples[min(int(q * len(samples)), len(samples) - 1)]
+
+    # Метод для получения сводки по гистограмме
+    def summary(self) -> dict[str, float]:
+        return {
+            "count": self.count,
+            "avg": self.total / self.count if self.count else 0.0,
+            "p50": self.percentile(0.5),
+            "p95": self.percentile(0.95),
+            "p99": self.percentile(0.99),
+        }
+
+
+# Реестр метрик: счетчики, гистограммы и функции, которые возвращают текущие значения по запросу
+class Metrics:
+    def __init__(
+        self,
+    ):
+        self._counters: dict[str, float] = {}
+        self._histograms: dict[str, Histogram] = {}
+        self._collectors: dict[str, Callable[[], dict[str, float]]] = {}
+        self._lock = threading.Lock()
+
+    # Метод для увеличения счетчика
+    def inc(self, name: str, value: float = 1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    # Метод для получения значения счетчика
+    def get(self, name: str) -> float:
+        return self._counters.get(name, 0)
+
+    # Метод для добавления наблюдения в гистограмму
+    def observe(self, name: str, value: float):
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram()
+            histogram.observe(value)
+
+    # Метод для получения гистограммы по имени
+    def histogram(self, name: str) -> Histogram:
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram()
+            return histogram
+
+    # Метод для регистрации функции, которая возвращает значения метрик с префиксом prefix
+    def register_collector(self, prefix: str, collector: Callable[[], dict[str, float]]):
+        self._collectors[prefix] = collector
+
+    # Метод для получения всех метрик в плоском виде
+    def snapshot(self) -> dict[str, float]:
+        with self._lock:
+            result = dict(self._counters)
+            histograms = list(self._histograms.items())
+        for name, histogram in histograms:
+            for key, value in histogram.summary().items():
+                result[f"{name}.{key}"] = value
+        for prefix, collector in self._collectors.items():
+            for key, value in collector().items():
+                result[f"{prefix}.{key}"] = value
+        return dict(sorted(result.items()))
+
+
+# Инициализируем инстанс реестра метрик
+metrics = Metrics()
@@ -4,8 +4,23 @@ from typing import Any, Callable, Awaitable, Dict
 
 from aiogram import (
     BaseMiddleware,
+    Bot,
 )
-from aiogram.types import Update, TelegramObject
+from aiogram.dispatcher.flags import (
+    get_flag,
+)
+from aiogram.client.session.middlewares.base import (
+    BaseRequestMiddleware,
+    NextRequestMiddlewareType,
+)
+from aiogram.exceptions import (
+    TelegramRetryAfter,
+)
+from aiogram.methods import (
+    Response,
+    TelegramMethod,
+)
+from aiogram.types import Update, TelegramObject, Message
 from aiogram.fsm.context import (
     FSMContext,
 )
@@ -14,6 +29,16 @@ import exceptions
 from handlers.bot.bot import (
     UserState,
 )
+from metrics import (
+    metrics,
+)
+from ratelimit import (
+    SendScheduler,
+    SlidingWindowLimiter,
+)
+from settings import (
+    settings,
+)
 from storage import (
     storage,
 )
@@ -38,7 +63,7 @@ class UserMiddleware(BaseMiddleware):
         # Объект для работы с состоянием пользователя
         state: FSMContext = data["state"]
         # Текущий пользователь в нашей системе который получен исходя из его tg user id
-        user = storage.get_user_for_tg_user_id(
+        user = await storage.get_user_for_tg_user_id(
             event.callback_query.from_user.id if event.callback_query is not None else event.message.from_user.id
         )
         data["user"] = user
@@ -57,3 +82,65 @@ class UserMiddleware(BaseMiddleware):
             event,
             data,
         )
+
+
+# Мидлваря для запросов бота в телеграмм, ограничивает частоту отправки сообщений.
+# Запросы без chat_id, например ответы на callback, не ограничиваются.
+# Если телеграмм все равно ответил 429, чат блокируется на retry_after секунд и запрос повторяется
+class RateLimitMiddleware(BaseRequestMiddleware):
+    def __init__(
+        self,
+        scheduler: SendScheduler,
+        max_retries: int,
+    ):
+        self.scheduler = scheduler
+        self.max_retries = max_retries
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType,
+        bot: Bot,
+        method: TelegramMethod,
+    ) -> Response:
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None:
+            return await make_request(bot, method)
+        attempt = 0
+        while True:
+            await self.scheduler.acquire(chat_id)
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                metrics.inc(f"{self.scheduler.name}.retry_after")
+                if attempt >= self.max_retries:
+                    raise
+                self.scheduler.block_chat(chat_id, e.retry_after)
+                attempt += 1
+
+
+# Мидлваря для хендлеров, которые отправляют вопрос в LLM, ограничивает частоту вопросов от одного пользователя.
+# Ограничиваются только хендлеры с флагом rate_limit, голосовые сообщения считаются отдельно от текста,
+# а админы не ограничиваются
+class QuestionRateLimitMiddleware(BaseMiddleware):
+    def __init__(
+        self,
+        text_limiter: SlidingWindowLimiter,
+        voice_limiter: SlidingWindowLimiter,
+    ):
+        self.text_limiter = text_limiter
+        self.voice_limiter = voice_limiter
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ):
+        user = data.get("event_from_user")
+        if not get_flag(data, "rate_limit") or user is None or user.id in settings.tg_user_id_admins:
+            return await handler(event, data)
+        limiter = self.voice_limiter if isinstance(event, Message) and event.voice is not None else self.text_limiter
+        retry_after = limiter.hit(user.id)
+        if retry_after > 0:
+            raise exceptions.TooManyQuestionsException(retry_after)
+        return await handler(event, data)
@@ -2,7 +2,7 @@
 from enum import StrEnum
 import pathlib
 import uuid
-from typing import Annotated
+from typing import Annotated, Optional
 from datetime import date, datetime
 
 
@@ -40,6 +40,30 @@ class Token(BaseModel, extra="forbid"):
     valid_until: int
 
 
+# Модель для хранения данных о рассылке
+class Broadcast(BaseModel, extra="forbid"):
+    id: int
+    text: str
+    status: str
+    total: int
+    sent: int
+    failed: int
+    last_user_id: int
+    created_at: int
+    finished_at: Optional[int] = None
+
+
+# Модель для формы создания рассылки в UI админке
+class BroadcastForm(BaseModel):
+    text: Annotated[str, Field(title="Текст рассылки", json_schema_extra={"format": "textarea"})]
+
+
+# Модель для отображения метрики приложения в UI админке
+class Metric(BaseModel, extra="forbid"):
+    name: str
+    value: str
+
+
 # Модель для формирования и хранения данных в форме в UI админке в блоке настроек
 class UpdateSettingsForm(BaseModel):
     yandex_model_uri: Annotated[str, Field(title="Путь до модели")]
@@ -0,0 +1,138 @@
+# Модуль для разбиения голосового сообщения OGG/Opus на части по границам страниц,
+# чтобы каждую часть можно было распознать отдельно
+
+import struct
+
+# Частота, в которой считается granule position у Opus
+OPUS_SAMPLE_RATE = 48000
+
+# Флаги заголовка страницы OGG
+CONTINUED = 0x01
+BOS = 0x02
+EOS = 0x04
+
+# Заголовок страницы: сигнатура, версия, флаги, granule position, serial, номер страницы, CRC, количество сегментов
+PAGE_HEADER = struct.Struct("<4sBBqIIIB")
+
+
+# Функция для построения таблицы CRC32 OGG: полином 0x04c11db7, без отражения битов
+def _crc_table() -> list[int]:
+    table = []
+    for i in range(256):
+        crc = i << 24
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x04C11DB7) if crc & 0x80000000 else crc << 1
+        table.append(crc & 0xFFFFFFFF)
+    return table
+
+
+CRC_TABLE = _crc_table()
+
+
+# Функция для подсчета CRC32 страницы OGG
+def ogg_crc(data: bytes) -> int:
+    crc = 0
+    for byte in data:
+        crc = ((crc << 8) & 0xFFFFFFFF) ^ CRC_TABLE[(crc >> 24) ^ byte]
+    return crc
+
+
+# Страница OGG
+class Page:
+    def __init__(
+        self,
+        flags: int,
+        granule: int,
+        serial: int,
+        sequence: int,
+        lacing: bytes,
+        body: bytes,
+    ):
+        self.flags = flags
+        self.granule = granule
+        self.serial = serial
+        self.sequence = sequence
+        # Таблица длин сегментов страницы
+        self.lacing = lacing
+        self.body = body
+
+    # Заканчивается ли на этой странице последний пакет, то есть можно ли резать поток после нее
+    @property
+    def ends_packet(self) -> bool:
+        return not self.lacing or self.lacing[-1] < 255
+
+    # Метод для сборки страницы в байты с пересчетом CRC
+    def to_bytes(self) -> bytes:
+        header = PAGE_HEADER.pack(b"OggS", 0, self.flags, self.granule, self.serial, self.sequence, 0, len(self.lacing))
+        data = bytearray(header + self.lacing + self.body)
+        struct.pack_into("<I", data, 22, ogg_crc(data))
+        return bytes(data)
+
+
+# Функция для разбора потока OGG на страницы, кидает ValueError если поток поврежден
+def parse_pages(content: bytes) -> list[Page]:
+    pages = []
+    offset = 0
+    while offset < len(content):
+        if len(content) - offset < PAGE_HEADER.size:
+            raise ValueError("Truncated OGG page header")
+        capture, version, flags, granule, serial, sequence, _, segments = PAGE_HEADER.unpack_from(content, offset)
+        if capture != b"OggS" or version != 0:
+            raise ValueError("Invalid OGG page")
+        offset += PAGE_HEADER.size
+        lacing = content[offset : offset + segments]
+        offset += segments
+        size = sum(lacing)
+        body = content[offset : offset + size]
+        if len(lacing) != segments or len(body) != size:
+            raise ValueError("Truncated OGG page")
+        offset += size
+        pages.append(Page(flags, granule, serial, sequence, lacing, body))
+    return pages
+
+
+# Функция для разбиения OGG/Opus на части длительностью не больше max_seconds.
+# Каждая часть - самостоятельный файл: заголовки OpusHead и OpusTags, затем страницы с аудио
+# с перенумерованными страницами и granule position, отсчитанной от начала части.
+# Если поток не удается разобрать или он и так короткий, возвращается исходный файл
+def split_ogg_opus(content: bytes, max_seconds: float) -> list[bytes]:
+    try:
+        pages = parse_pages(content)
+    except ValueError:
+        return [content]
+    # Заголовочные страницы идут первыми и имеют нулевую granule position
+    headers_count = 0
+    while headers_count < len(pages) and pages[headers_count].granule == 0:
+        headers_count += 1
+    headers, audio = pages[:headers_count], pages[headers_count:]
+    if not headers or not headers[0].body.startswith(b"OpusHead") or not audio:
+        return [content]
+    pre_skip = struct.unpack_from("<H", headers[0].body, 10)[0]
+    max_samples = int(max_seconds * OPUS_SAMPLE_RATE)
+    if audio[-1].granule - pre_skip <= max_samples:
+        return [content]
+
+    # Группируем страницы с аудио. Резать можно только после страницы, на которой заканчивается пакет
+    chunks: list[list[Page]] = []
+    current: list[Page] = []
+    base = 0
+    for page in audio:
+        if current and current[-1].ends_packet and page.granule - base > max_samples + pre_skip:
+            chunks.append(current)
+            base = current[-1].granule
+            current = []
+        current.append(page)
+    chunks.append(current)
+
+    result = []
+    base = 0
+    for chunk in chunks:
+        data = [page.to_bytes() for page in headers]
+        for i, page in enumerate(chunk):
+            # Декодер отбросит pre_skip отсчетов в начале каждой части, поэтому учитываем их в granule position
+            granule = page.granule - base + pre_skip if base else page.granule
+            flags = page.flags & ~(BOS | EOS) | (EOS if i == len(chunk) - 1 else 0)
+            data.append(Page(flags, granule, page.serial, headers_count + i, page.lacing, page.body).to_bytes())
+        base = chunk[-1].granule
+        result.append(b"".join(data))
+    return result
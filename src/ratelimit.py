@@ -0,0 +1,191 @@
+# Модуль для ограничения частоты отправки сообщений в телеграмм и частоты вопросов от пользователей
+
+import asyncio
+import time
+from collections import deque
+from typing import Hashable
+
+from metrics import (
+    metrics,
+)
+from settings import (
+    settings,
+)
+
+
+# Корзина токенов: пропускает в среднем rate запросов в секунду и до capacity запросов подряд.
+# Токены можно брать в долг, тогда запрос должен подождать, пока долг не восполнится
+class TokenBucket:
+    def __init__(
+        self,
+        rate: float,
+        capacity: float,
+    ):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        # Время, до которого телеграмм попросил ничего не отправлять
+        self.blocked_until = 0.0
+
+    # Метод для пополнения корзины за прошедшее время
+    def refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    # Метод для резервирования токена, возвращает сколько секунд нужно подождать перед отправкой
+    def reserve(self) -> float:
+        now = time.monotonic()
+        self.refill(now)
+        self.tokens -= 1
+        delay = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        return max(delay, self.blocked_until - now)
+
+    # Метод для блокировки отправки на seconds секунд
+    def block(self, seconds: float):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    # Простаивает ли корзина: полная и не заблокирована, такую можно удалить и создать заново без потерь
+    def idle(self, now: float) -> bool:
+        self.refill(now)
+        return self.tokens >= self.capacity and self.blocked_until <= now
+
+
+# Планировщик отправки сообщений с общим ограничением для всего бота и отдельным для каждого чата
+class SendScheduler:
+    def __init__(
+        self,
+        name: str,
+        global_rate: float,
+        global_burst: float,
+        chat_rate: float,
+        chat_burst: float,
+        sweep_every: int = 1000,
+    ):
+        self.name = name
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.sweep_every = sweep_every
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.chat_buckets: dict[Hashable, TokenBucket] = {}
+        self._acquired = 0
+        self._waiting = 0
+        self.wait = metrics.histogram(f"{name}.wait_seconds")
+        metrics.register_collector(name, self.stats)
+
+    # Метод для получения корзины чата
+    def chat_bucket(self, chat_id: Hashable) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    # Метод для ожидания разрешения на отправку в чат. Сначала ждем очередь чата,
+    # и только потом берем общий токен, чтобы сообщения одного чата не занимали общую очередь зря
+    async def acquire(self, chat_id: Hashable):
+        started = time.monotonic()
+        self._waiting += 1
+        try:
+            delay = self.chat_bucket(chat_id).reserve()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            delay = self.global_bucket.reserve()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        finally:
+            self._waiting -= 1
+        self.wait.observe(time.monotonic() - started)
+        self._acquired += 1
+        if self._acquired % self.sweep_every == 0:
+            self.sweep()
+
+    # Метод для блокировки отправки в чат, когда телеграмм ответил 429
+    def block_chat(self, chat_id: Hashable, seconds: float):
+        self.chat_bucket(chat_id).block(seconds)
+
+    # Метод для удаления корзин чатов, в которые давно ничего не отправлялось
+    def sweep(self):
+        now = time.monotonic()
+        for chat_id in [chat_id for chat_id, bucket in self.chat_buckets.items() if bucket.idle(now)]:
+            del self.chat_buckets[chat_id]
+
+    # Метод для получения метрик планировщика
+    def stats(self) -> dict[str, float]:
+        return {
+            "waiting": self._waiting,
+            "chats": len(self.chat_buckets),
+        }
+
+
+# Ограничение частоты по скользящему окну: у каждого ключа не больше limit событий за последние window секунд.
+# Для каждого ключа хранится время его последних событий, не больше limit штук.
+# Раз в sweep_interval секунд удаляются ключи, у которых все события вышли за окно
+class SlidingWindowLimiter:
+    def __init__(
+        self,
+        name: str,
+        limit: int,
+        window: float,
+        sweep_interval: float,
+    ):
+        self.name = name
+        self.limit = limit
+        self.window = window
+        self.sweep_interval = sweep_interval
+        self.events: dict[Hashable, deque[float]] = {}
+        self.swept_at = time.monotonic()
+        metrics.register_collector(name, self.stats)
+
+    # Метод для учета нового события ключа.
+    # Возвращает 0, если событие разрешено, иначе сколько секунд осталось до освобождения места в окне
+    def hit(self, key: Hashable) -> float:
+        now = time.monotonic()
+        if now - self.swept_at >= self.sweep_interval:
+            self.sweep(now)
+        events = self.events.get(key)
+        if events is None:
+            events = self.events[key] = deque(maxlen=self.limit)
+        while events and events[0] <= now - self.window:
+            events.popleft()
+        if len(events) >= self.limit:
+            metrics.inc(f"{self.name}.rejected")
+            return events[0] + self.window - now
+        events.append(now)
+        return 0.0
+
+    # Метод для удаления ключей, у которых нет событий в текущем окне
+    def sweep(self, now: float):
+        self.swept_at = now
+        for key in [key for key, events in self.events.items() if not events or events[-1] <= now - self.window]:
+            del self.events[key]
+
+    # Метод для получения метрик
+    def stats(self) -> dict[str, float]:
+        return {
+            "users": len(self.events),
+        }
+
+
+# Инициализируем планировщик отправки сообщений в телеграмм.
+# Общий лимит телеграмма действует на весь бот, поэтому делим его поровну между процессами uvicorn
+telegram_sender = SendScheduler(
+    "telegram_sender",
+    settings.tg_global_rate / settings.web_concurrency,
+    max(settings.tg_global_burst / settings.web_concurrency, 1),
+    settings.tg_chat_rate,
+    settings.tg_chat_burst,
+)
+
+# Инициализируем ограничения на вопросы от одного пользователя, отдельно для текста и для голосовых сообщений
+text_questions_limiter = SlidingWindowLimiter(
+    "text_questions",
+    settings.user_text_questions_limit,
+    settings.user_questions_window,
+    settings.user_questions_sweep_interval,
+)
+voice_questions_limiter = SlidingWindowLimiter(
+    "voice_questions",
+    settings.user_voice_questions_limit,
+    settings.user_questions_window,
+    settings.user_questions_sweep_interval,
+)
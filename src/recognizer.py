@@ -1,45 +1,75 @@
 # Модуль для работы с разпознованием голоса
 
+import asyncio
+import hashlib
 from typing import Literal
 
-import httpx
-
+from http_clients import http_clients
+from ogg import split_ogg_opus
 from settings import settings
+from singleflight import SingleFlight
+from upstream import Upstream
 
 
 # Класс для работы с разпознованием голоса
 class Recognizer:
     def __init__(self):
         self.yc_uri = "https://stt.api.cloud.yandex.net/speech/v1/stt:recognize"
+        # Ограничение количества одновременных запросов на распознавание всех частей всех сообщений
+        self.pool = asyncio.Semaphore(settings.stt_max_parallel)
+
+    # Метод для распознования голоса. Длинное голосовое сообщение OGG/Opus режется на части,
+    # которые распознаются одновременно, а текст склеивается в исходном порядке
+    async def recognize(self, content: bytes, format_audio: Literal["lpcm", "oggopus"]) -> str:
+        if format_audio == "oggopus":
+            # Разбор и пересчет CRC страниц занимает заметное время, поэтому выполняем его в потоке
+            chunks = await asyncio.to_thread(split_ogg_opus, content, settings.stt_chunk_seconds)
+        else:
+            chunks = [content]
+        texts = await asyncio.gather(*(self.recognize_chunk(chunk, format_audio) for chunk in chunks))
+        return " ".join(text for text in texts if text)
+
+    # Метод для распознования одной части голоса, одинаковые одновременные запросы объединяются в один
+    async def recognize_chunk(self, content: bytes, format_audio: Literal["lpcm", "oggopus"]) -> str:
+        key = (hashlib.sha256(content).hexdigest(), format_audio)
+        return await stt_flights.do(key, lambda: self.request_limited(content, format_audio))
+
+    # Метод для отправки голоса на распознавание с ожиданием свободного места в пуле
+    async def request_limited(self, content: bytes, format_audio: Literal["lpcm", "oggopus"]) -> str:
+        async with self.pool:
+            return await stt_upstream.call(lambda: self.request(content, format_audio))
 
-    # Метод для распознования голоса
-    async def recognize(self, file_path: str, format_audio: Literal["lpcm", "oggopus"]) -> str:
-        async with httpx.AsyncClient() as client:
-            with open(file_path, "rb") as file:
-                r = await client.post(
-                    self.yc_uri,
-                    headers={"Authorization": f"Bearer {settings.token}"},
-                    params={
-                        # Указываем язык
-                        "lang": "ru-RU",
-                        # Указываем готовую yandex модель для распознования голоса
-                        "topic": "general",
-                        # Указываем что не надо фильтровать мат из голоса
-                        "profanityFilter": False,
-                        # Указываем что числа идут как обычный текст
-                        "rawResults": False,
-                        # Указываем формат аудио
-                        "format": format_audio,
-                        # Указываем id yandex cloud папки
-                        "folderid": settings.folder_id,
-                    },
-                    # Считываем байты голоса и отправляем на сервер yandex
-                    content=file.read(),
-                )
-                # Выкидываем исключения если ответ неуспешен
-                r.raise_for_status()
-                # Получаем текст из разшифрованного голоса
-                return r.json()["result"]
+    # Метод для отправки голоса на распознавание в yandex cloud
+    async def request(self, content: bytes, format_audio: Literal["lpcm", "oggopus"]) -> str:
+        r = await http_clients.client.post(
+            self.yc_uri,
+            headers={"Authorization": f"Bearer {settings.token}"},
+            params={
+                # Указываем язык
+                "lang": "ru-RU",
+                # Указываем готовую yandex модель для распознования голоса
+                "topic": "general",
+                # Указываем что не надо фильтровать мат из голоса
+                "profanityFilter": False,
+                # Указываем что числа идут как обычный текст
+                "rawResults": False,
+                # Указываем формат аудио
+                "format": format_audio,
+                # Указываем id yandex cloud папки
+                "folderid": settings.folder_id,
+            },
+            # Отправляем байты голоса на сервер yandex
+            content=content,
+            timeout=http_clients.stt_timeout,
+        )
+        # Выкидываем исключения если ответ неуспешен
+        r.raise_for_status()
+        # Получаем текст из разшифрованного голоса
+        return r.json()["result"]
 
 
+# Инициализируем объединение одинаковых одновременных запросов на распознавание
+stt_flights = SingleFlight("stt_flights")
+# Инициализируем устойчивые вызовы распознавания голоса
+stt_upstream = Upstream("stt")
 recognizer = Recognizer()
@@ -18,6 +18,7 @@ from pydantic import (
     BaseModel,
     UrlConstraints,
     DirectoryPath,
+    PositiveInt,
     computed_field,
 )
 from pydantic_core import (
@@ -54,6 +55,32 @@ class Settings(
     key_json_file: pathlib.Path
     # Путь до sqlite3 файла
     db_path: pathlib.Path = pathlib.Path("db.db")
+    # Количество потоков в пуле, который выполняет запросы к базе данных
+    db_executor_workers: int = 4
+    # Максимальное количество пользователей в кэше
+    users_cache_size: int = 10000
+    # Время жизни пользователя в кэше в секундах
+    users_cache_ttl: int = 300
+    # Максимальное количество состояний FSM в кэше в памяти
+    fsm_cache_size: int = 10000
+    # Время жизни состояния FSM в кэше в памяти в секундах
+    fsm_cache_ttl: int = 300
+    # Сколько последних изменений FSM хранится в журнале для сброса кэша в других процессах
+    fsm_changes_keep: int = 10000
+    # Сколько последних изменений токенов, пользователей и настроек хранится в журнале для других процессов
+    changes_keep: int = 10000
+    # Время жизни состояния FSM в секундах для отдельных состояний, отсчитывается от последнего изменения
+    fsm_state_ttls: dict[str, int] = {
+        "UserState:wait_for_llm_question": 24 * 60 * 60,
+    }
+    # Время жизни состояния FSM в секундах для остальных состояний, например для незаконченной регистрации
+    fsm_default_ttl: int = 3 * 24 * 60 * 60
+    # Максимальное количество записей FSM в базе данных
+    fsm_max_entries: int = 100000
+    # Максимальный суммарный размер записей FSM в базе данных в байтах
+    fsm_max_bytes: int = 64 * 1024 * 1024
+    # Интервал между очистками FSM от просроченных и лишних записей в секундах
+    fsm_compaction_interval: float = 300
     # Путь до файла где хранятся последние сохранившиеся данные для генерации файла для обучение
     fine_tuning_saved_form_data_file: pathlib.Path
     # Путь до папки где будут храниться сгенерировшиеся файлы
@@ -63,6 +90,120 @@ class Settings(
     # Список с tg id которые являются админами
     tg_user_id_admins: list[int] = []
     temperature_model: float = 0.1
+    # Минимальная похожесть вопроса на вопрос из template.json, при которой ответ берется из шаблона
+    faq_min_score: float = 0.85
+    # Максимальное количество одновременных запросов к LLM
+    llm_max_in_flight: int = 10
+    # Максимальное количество запросов к LLM, которые могут ждать в очереди
+    llm_max_queue: int = 200
+    # Максимальный размер голосового сообщения в байтах, которое скачивается в память
+    voice_max_bytes: int = 1024 * 1024
+    # Максимальная длительность голосового сообщения в секундах
+    voice_max_duration: int = 60
+    # Максимальная длительность части голосового сообщения, которая отправляется на распознавание одним запросом
+    stt_chunk_seconds: float = 10
+    # Максимальное количество одновременных запросов на распознавание голоса
+    stt_max_parallel: int = 8
+    # Максимальное количество распознанных голосовых сообщений в кэше в памяти
+    transcription_cache_size: int = 1000
+    # Время жизни распознанного голосового сообщения в кэше в памяти в секундах
+    transcription_cache_ttl: int = 3600
+    # Максимальное количество распознанных голосовых сообщений, которые хранятся в базе данных
+    transcription_db_max_rows: int = 100000
+    # Получать ли ответ LLM по частям с постепенным редактированием сообщения
+    llm_streaming: bool = True
+    # Минимальный интервал между редактированиями сообщения с ответом LLM в секундах
+    llm_stream_edit_interval: float = 1.0
+    # Максимальное количество ответов LLM в кэше в памяти
+    answer_cache_size: int = 1000
+    # Время жизни закэшированного ответа LLM в секундах
+    answer_cache_ttl: int = 86400
+    # Максимальное количество соединений в общем пуле HTTP клиента
+    http_max_connections: int = 100
+    # Максимальное количество простаивающих соединений, которые держатся открытыми
+    http_max_keepalive_connections: int = 20
+    # Время в секундах, через которое простаивающее соединение закрывается
+    http_keepalive_expiry: float = 60
+    # Таймаут на установку соединения в секундах
+    http_connect_timeout: float = 5
+    # Количество повторов запроса в yandex cloud при ответах 429 и 5xx
+    upstream_retries: int = 2
+    # Базовая задержка перед повтором запроса в секундах, растет экспоненциально
+    upstream_retry_base_delay: float = 0.5
+    # Отправлять ли дублирующий запрос, если ответ задерживается
+    upstream_hedge_enabled: bool = True
+    # Перцентиль времени ответа, после которого отправляется дублирующий запрос
+    upstream_hedge_quantile: float = 0.95
+    # Минимальное количество замеров, после которого задержка считается по перцентилю
+    upstream_hedge_min_samples: int = 20
+    # Минимальная задержка перед дублирующим запросом в секундах
+    upstream_hedge_min_delay: float = 1
+    # Максимальная задержка перед дублирующим запросом в секундах
+    upstream_hedge_max_delay: float = 15
+    # Количество ошибок подряд, после которого запросы в сервис временно не отправляются
+    circuit_breaker_failures: int = 5
+    # Время в секундах, на которое запросы в сервис перестают отправляться
+    circuit_breaker_cooldown: float = 30
+    # Количество воркеров, которые обрабатывают быстрые обновления из телеграмма: меню и регистрацию
+    webhook_fast_workers: int = 16
+    # Максимальное количество быстрых обновлений, которые ждут обработки
+    webhook_fast_queue_size: int = 1000
+    # Количество воркеров, которые обрабатывают вопросы к LLM и голосовые сообщения
+    webhook_slow_workers: int = 32
+    # Максимальное количество вопросов к LLM и голосовых сообщений, которые ждут обработки
+    webhook_slow_queue_size: int = 500
+    # Сколько последних update_id каждый процесс помнит в памяти, чтобы не ходить за повторами в базу данных
+    webhook_dedup_size: int = 10000
+    # Сколько секунд помнить update_id, чтобы не обрабатывать повторную доставку обновления
+    webhook_dedup_window: float = 600
+    # Время в секундах, которое при остановке дается на обработку обновлений из очереди
+    webhook_shutdown_timeout: float = 30
+    # Максимальное количество сообщений в секунду, которые бот отправляет во все чаты, на все процессы вместе
+    tg_global_rate: float = 30
+    # Сколько сообщений во все чаты можно отправить подряд без ожидания, на все процессы вместе
+    tg_global_burst: float = 30
+    # Максимальное количество сообщений в секунду, которые бот отправляет в один чат
+    tg_chat_rate: float = 1
+    # Сколько сообщений в один чат можно отправить подряд без ожидания
+    tg_chat_burst: float = 3
+    # Сколько раз повторять отправку, если телеграмм ответил 429 с retry_after
+    tg_retry_after_retries: int = 3
+    # Количество пользователей, которые читаются из базы данных за раз при рассылке
+    broadcast_chunk_size: int = 100
+    # Максимальное количество одновременно отправляемых сообщений рассылки
+    broadcast_concurrency: int = 10
+    # Максимальное количество сообщений рассылки в секунду
+    broadcast_rate: float = 20
+    # Время в секундах, после которого рассылку, по которой нет прогресса, подхватывает другой процесс
+    broadcast_lease: int = 60
+    # Сколько текстовых вопросов и команд /ask один пользователь может отправить за окно, не меньше 1
+    user_text_questions_limit: PositiveInt = 10
+    # Сколько голосовых вопросов один пользователь может отправить за окно, не меньше 1
+    user_voice_questions_limit: PositiveInt = 5
+    # Длина окна в секундах, за которое считаются вопросы пользователя
+    user_questions_window: float = 60
+    # Как часто в секундах удалять из памяти счетчики пользователей, которые давно ничего не спрашивали
+    user_questions_sweep_interval: float = 300
+    # Таймаут запроса к LLM в секундах
+    llm_timeout: float = 60
+    # Таймаут запроса на распознавание голоса в секундах
+    stt_timeout: float = 30
+    # Таймаут запроса на получение IAM токена в секундах
+    iam_timeout: float = 10
+
+    # Метод для получения времени жизни состояния FSM в секундах
+    def fsm_ttl(
+        self,
+        state: Optional[str],
+    ) -> int:
+        return self.fsm_state_ttls.get(state, self.fsm_default_ttl)
+
+    # Количество процессов uvicorn, uvicorn берет его из переменной окружения WEB_CONCURRENCY
+    @property
+    def web_concurrency(
+        self,
+    ) -> int:
+        return max(int(os.environ.get("WEB_CONCURRENCY", 1)), 1)
 
     # Вычисляемое поле которое хранит путь для вебхука
     @computed_field
@@ -111,14 +252,17 @@ class Settings(
             algorithm="PS256",
             headers={"kid": key["id"]},
         )
-        async with httpx.AsyncClient() as client:
-            r = await client.post(
-                "https://iam.api.cloud.yandex.net/iam/v1/tokens",
-                json={"jwt": encoded_token},
-            )
-            if not r.is_success:
-                return r
-            self.token = r.json()["iamToken"]
+        # Импорт внутри метода, так как модуль http_clients сам зависит от настроек
+        from http_clients import http_clients
+
+        r = await http_clients.client.post(
+            "https://iam.api.cloud.yandex.net/iam/v1/tokens",
+            json={"jwt": encoded_token},
+            timeout=http_clients.iam_timeout,
+        )
+        if not r.is_success:
+            return r
+        self.token = r.json()["iamToken"]
         return None
 
     # Метод для загрузки настроек из yaml файла
@@ -132,6 +276,13 @@ class Settings(
 
         return cls(**cfg, self_path=path)
 
+    # Перечитать из своего файла настройки, которые меняются из административной панели.
+    # Нужно, когда настройки поменяли в другом процессе
+    def reload_from_self_file(self):
+        saved = self.from_yaml(self.self_path)
+        self.yandex_model_uri = saved.yandex_model_uri
+        self.temperature_model = saved.temperature_model
+
     # Сохранить текущее состояние настроек в свой же файл
     def dump_to_self_file(self):
         # Does not save дата начала приемной комиссии
@@ -0,0 +1,71 @@
+# Модуль для объединения одинаковых одновременных запросов в один запрос к внешнему сервису
+
+import asyncio
+import functools
+from typing import Any, Awaitable, Callable, Hashable
+
+from metrics import (
+    metrics,
+)
+
+
+# Если запрос с таким же ключом уже выполняется, новый вызов не делает свой запрос,
+# а дожидается результата уже выполняющегося.
+# Запрос отменяется, когда его результата больше никто не ждет
+class SingleFlight:
+    def __init__(
+        self,
+        name: str,
+    ):
+        self.name = name
+        self._calls: dict[Hashable, asyncio.Task] = {}
+        # Сколько вызовов ждут результата каждого запроса
+        self._waiters: dict[asyncio.Task, int] = {}
+
+    # Метод для запуска запроса или присоединения к уже выполняющемуся.
+    # Возвращает задачу и признак того, что запрос запустил именно этот вызов.
+    # После start вызов обязательно должен вызвать release, когда перестанет ждать результат
+    def start(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> tuple[asyncio.Task, bool]:
+        task = self._calls.get(key)
+        if task is not None:
+            metrics.inc(f"{self.name}.collapsed")
+            self._waiters[task] += 1
+            return task, False
+        task = asyncio.create_task(fn())
+        self._calls[key] = task
+        self._waiters[task] = 1
+        task.add_done_callback(functools.partial(self._done, key))
+        metrics.inc(f"{self.name}.calls")
+        return task, True
+
+    # Метод, который вызывается, когда вызов перестал ждать результат запроса.
+    # Если это был последний ожидающий, а запрос еще не закончился, отменяем запрос
+    def release(self, key: Hashable, task: asyncio.Task):
+        waiters = self._waiters.get(task, 0) - 1
+        if waiters > 0:
+            self._waiters[task] = waiters
+            return
+        self._waiters.pop(task, None)
+        if not task.done():
+            # Новые вызовы с этим ключом не должны присоединяться к отмененному запросу
+            if self._calls.get(key) is task:
+                del self._calls[key]
+            task.cancel()
+            metrics.inc(f"{self.name}.cancelled")
+
+    # Метод для выполнения запроса с объединением одинаковых одновременных вызовов
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        task, _ = self.start(key, fn)
+        try:
+            # shield нужен, чтобы отмена одного из ожидающих не отменяла запрос для остальных
+            return await asyncio.shield(task)
+        finally:
+            self.release(key, task)
+
+    def _done(self, key: Hashable, task: asyncio.Task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        self._waiters.pop(task, None)
+        # Забираем исключение, чтобы asyncio не ругался, если результат никто не дождался
+        if not task.cancelled():
+            task.exception()
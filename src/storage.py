@@ -1,22 +1,69 @@
 # Модуль отвечающий за работу с базой данных
 
 import asyncio
+import functools
 import pathlib
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import Optional, NoReturn
+from typing import Any, Callable, Optional, NoReturn
 import sqlite3
 
 from loguru import logger
 
+from expiry import (
+    ExpiryScheduler,
+)
+from cache import (
+    TTLCache,
+    MISSING,
+)
+from changes import (
+    ChangeLog,
+)
+from metrics import (
+    metrics,
+)
 from models import (
     User,
     File,
     Token,
+    Broadcast,
 )
 from settings import (
     settings,
 )
+from tokens import (
+    TokenIndex,
+)
+
+
+# Колонки таблицы broadcasts в порядке, который ожидает Storage.broadcast_from_row
+BROADCAST_COLUMNS = "id, text, status, total, sent, failed, last_user_id, created_at, finished_at"
+
+# Настройки которые применяются к каждому новому подключению к базе данных
+CONNECTION_PRAGMAS = [
+    # WAL позволяет читать параллельно с записью и не делать fsync на каждую транзакцию
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    # Ждем освобождения блокировки вместо мгновенной ошибки database is locked
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    # Размер кэша страниц в KiB (отрицательное значение)
+    "PRAGMA cache_size=-16000",
+]
+
+
+# Декоратор, который превращает синхронный метод Storage в корутину,
+# выполняющуюся в отдельном пуле потоков, чтобы не блокировать event loop
+def in_executor(method):
+    @functools.wraps(method)
+    async def wrapper(self: "Storage", *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(method, self, *args, **kwargs))
+
+    return wrapper
 
 
 # Класс для работы с базой данных
@@ -24,17 +71,78 @@ class Storage:
     def __init__(
         self,
         db_path: pathlib.Path,
+        executor_workers: int,
+        users_cache_size: int,
+        users_cache_ttl: float,
     ):
         # Сохраняем путь до sqlite3 файла
         self.db_path = db_path
+        # Ограниченный пул потоков, в котором выполняются все запросы к базе данных
+        self.executor = ThreadPoolExecutor(max_workers=executor_workers, thread_name_prefix="storage")
+        # У каждого потока пула свое долгоживущее подключение
+        self._local = threading.local()
+        self._connections: list[sqlite3.Connection] = []
+        self._connections_lock = threading.Lock()
+        # Кэш пользователей по tg user id, чтобы не ходить в базу данных на каждое обновление от телеграм
+        self.users_cache = TTLCache(maxsize=users_cache_size, ttl=users_cache_ttl)
+        # Закэшированное количество пользователей, обновляется при создании пользователя
+        self._users_count: Optional[int] = None
+        self._users_count_lock = threading.Lock()
+        # Индекс действующих токенов, база данных нужна только чтобы пережить перезапуск
+        self.tokens_index = TokenIndex()
+        # Планировщик удаления просроченных токенов и файлов
+        self.expiry = ExpiryScheduler()
+        self.expiry.register("tokens", self.delete_expired_tokens)
+        self.expiry.register("files", self.delete_expired_files)
+        self.expiry.register("llm_answers", self.delete_expired_llm_answers)
+        # Журнал изменений, по которому процесс узнает об удаленных токенах, измененных пользователях
+        # и настройках из других процессов, и обработчики изменений по темам
+        self.changes = ChangeLog(db_path, "changes", "topic, key")
+        self._subscribers: dict[str, list[Callable[[Optional[str]], Any]]] = {}
+        self.subscribe("tokens", self.apply_token_change)
+        self.subscribe("users", self.apply_user_change)
         # Проводим первичную инициализацию базы данных
         self.setup_database()
+        # Запоминаем конец журнала до загрузки токенов, чтобы не пропустить изменения после загрузки
+        self.changes.conn()
+        # Загружаем действующие токены в память
+        self.load_tokens()
 
-    # Метод для получения подключения к базе данных
+    # Метод для получения подключения к базе данных текущего потока
     def get_conn(
         self,
     ) -> sqlite3.Connection:
-        return sqlite3.connect(self.db_path)
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            return conn
+        conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        for pragma in CONNECTION_PRAGMAS:
+            conn.execute(pragma)
+        self._local.conn = conn
+        with self._connections_lock:
+            self._connections.append(conn)
+        return conn
+
+    # Метод для запуска фоновых задач хранилища
+    async def start(
+        self,
+    ) -> NoReturn:
+        # Таймеры восстанавливаются из базы данных, уже истекшие сработают сразу
+        for kind, key, valid_until in await self.list_expiry_timers():
+            self.expiry.schedule(kind, key, valid_until)
+        self.expiry.start()
+
+    # Метод для остановки фоновых задач, пула потоков и закрытия всех подключений
+    async def close(
+        self,
+    ) -> NoReturn:
+        await self.expiry.stop()
+        self.executor.shutdown(wait=True)
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+        self.changes.close()
 
     # Метод для создания нужных таблиц и индексов для работы нашего приложения
     def setup_database(
@@ -62,17 +170,125 @@ class Storage:
             "value TEXT UNIQUE NOT NULL, "
             "valid_until INTEGER NOT NULL"
             ")",
+            "CREATE TABLE IF NOT EXISTS llm_answers("
+            "key TEXT PRIMARY KEY NOT NULL,"
+            "answer TEXT NOT NULL,"
+            "valid_until INTEGER NOT NULL"
+            ")",
+            "CREATE TABLE IF NOT EXISTS transcriptions("
+            "file_unique_id TEXT PRIMARY KEY NOT NULL,"
+            "text TEXT NOT NULL,"
+            "created_at INTEGER NOT NULL"
+            ")",
+            "CREATE TABLE IF NOT EXISTS fsm("
+            "key TEXT PRIMARY KEY NOT NULL,"
+            "state TEXT,"
+            "data TEXT NOT NULL DEFAULT '{}',"
+            "seq INTEGER NOT NULL,"
+            "updated_at INTEGER NOT NULL"
+            ")",
+            # Журнал изменений FSM, по нему другие процессы узнают, какие записи в их кэше устарели
+            "CREATE TABLE IF NOT EXISTS fsm_changes("
+            "seq INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,"
+            "key TEXT NOT NULL"
+            ")",
+            # Журнал изменений токенов, пользователей и настроек для других процессов.
+            # topic - что изменилось, key - ключ измененной записи
+            "CREATE TABLE IF NOT EXISTS changes("
+            "seq INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,"
+            "topic TEXT NOT NULL,"
+            "key TEXT NOT NULL"
+            ")",
+            # Недавно принятые обновления телеграмма, чтобы повторная доставка в любой процесс не обработалась дважды
+            "CREATE TABLE IF NOT EXISTS webhook_updates("
+            "update_id INTEGER PRIMARY KEY NOT NULL,"
+            "received_at INTEGER NOT NULL"
+            ")",
+            # Рассылки: last_user_id - id последнего пользователя из tg_users, до которого рассылка дошла.
+            # owner и heartbeat_at - процесс, который сейчас отправляет рассылку, и время его последней отметки
+            "CREATE TABLE IF NOT EXISTS broadcasts("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,"
+            "text TEXT NOT NULL,"
+            "status TEXT NOT NULL,"
+            "total INTEGER NOT NULL,"
+            "sent INTEGER NOT NULL DEFAULT 0,"
+            "failed INTEGER NOT NULL DEFAULT 0,"
+            "last_user_id INTEGER NOT NULL DEFAULT 0,"
+            "owner TEXT,"
+            "heartbeat_at INTEGER NOT NULL,"
+            "created_at INTEGER NOT NULL,"
+            "finished_at INTEGER"
+            ")",
             "CREATE INDEX IF NOT EXISTS tg_user_id_tg_users_idx ON tg_users (tg_user_id)",
             "CREATE INDEX IF NOT EXISTS value_tokens_idx ON tokens (value)",
             "CREATE INDEX IF NOT EXISTS valid_until_tokens_idx ON tokens (valid_until)",
             "CREATE INDEX IF NOT EXISTS valid_until_files_idx ON files (valid_until)",
+            "CREATE INDEX IF NOT EXISTS created_at_transcriptions_idx ON transcriptions (created_at)",
+            "CREATE INDEX IF NOT EXISTS received_at_webhook_updates_idx ON webhook_updates (received_at)",
+            "CREATE INDEX IF NOT EXISTS state_updated_at_fsm_idx ON fsm (state, updated_at)",
+            "CREATE INDEX IF NOT EXISTS updated_at_fsm_idx ON fsm (updated_at)",
         ]
         with self.get_conn() as conn:
             cursor = conn.cursor()
             for query in queries:
                 cursor.execute(query)
 
+    # Метод для подписки на изменения темы topic из журнала. callback вызывается в пуле потоков с ключом
+    # измененной записи или с None, если часть журнала уже удалена и измениться могло что угодно
+    def subscribe(self, topic: str, callback: Callable[[Optional[str]], Any]):
+        self._subscribers.setdefault(topic, []).append(callback)
+
+    # Метод для записи изменения в журнал в той же транзакции, что и само изменение.
+    # Из журнала удаляются изменения старше последних changes_keep
+    @staticmethod
+    def write_change(cursor: sqlite3.Cursor, topic: str, key: str):
+        cursor.execute("INSERT INTO changes(topic, key) VALUES (?, ?) RETURNING seq", (topic, key))
+        seq = cursor.fetchone()[0]
+        cursor.execute("DELETE FROM changes WHERE seq <= ?", (seq - settings.changes_keep,))
+
+    # Метод для записи в журнал изменения, которое хранится не в базе данных, например настроек
+    @in_executor
+    def notify_change(self, topic: str, key: str = "") -> NoReturn:
+        with self.get_conn() as conn:
+            self.write_change(conn.cursor(), topic, key)
+
+    # Метод для применения изменений, которые записали в журнал все процессы, включая этот.
+    # Вызывается перед чтением кэшей, которые могли устареть
+    @in_executor
+    def sync_changes(self) -> NoReturn:
+        self.changes.read(self.apply_changes)
+
+    # Метод для вызова обработчиков изменений
+    def apply_changes(self, changes: Optional[list[tuple[int, str, str]]]):
+        if changes is None:
+            metrics.inc("changes.resets")
+            for callbacks in self._subscribers.values():
+                for callback in callbacks:
+                    callback(None)
+            return
+        for _, topic, key in changes:
+            for callback in self._subscribers.get(topic, []):
+                callback(key)
+
+    # Метод для применения изменения токена: удаленный токен убираем из индекса.
+    # Если неизвестно, что изменилось, очищаем индекс, токены будут проверяться по базе данных
+    def apply_token_change(self, value: Optional[str]):
+        if value is None:
+            self.tokens_index.clear()
+        else:
+            self.tokens_index.discard(value)
+
+    # Метод для применения изменения пользователя: убираем его из кэша и сбрасываем количество пользователей
+    def apply_user_change(self, tg_user_id: Optional[str]):
+        if tg_user_id is None:
+            self.users_cache.clear()
+        else:
+            self.users_cache.invalidate(int(tg_user_id))
+        with self._users_count_lock:
+            self._users_count = None
+
     # Метод для создания пользователя после его регистрации в боте
+    @in_executor
     def create_tg_user(
         self,
         tg_user_id: int,
@@ -85,7 +301,8 @@ class Storage:
         query = (
             "INSERT INTO "
             "tg_users(tg_user_id, tg_user_city, tg_user_phone, tg_user_email, tg_user_first_name, tg_user_last_name) "
-            "VALUES (?, ?, ?, ?, ?, ?)"
+            "VALUES (?, ?, ?, ?, ?, ?) "
+            "RETURNING id, tg_user_id, tg_user_city, tg_user_phone, tg_user_email, tg_user_first_name, tg_user_last_name"
         )
         with self.get_conn() as conn:
             cursor = conn.cursor()
@@ -93,53 +310,85 @@ class Storage:
                 query,
                 (tg_user_id, tg_user_city, tg_user_phone, tg_user_email, tg_user_first_name, tg_user_last_name),
             )
+            row = cursor.fetchone()
+            self.write_change(cursor, "users", str(tg_user_id))
+        self.cache_user_row(tg_user_id, row)
+        with self._users_count_lock:
+            if self._users_count is not None:
+                self._users_count += 1
 
     # Метод для обновления города пользователя
+    @in_executor
     def update_tg_user_city(self, tg_user_id: int, tg_user_city: str) -> NoReturn:
         query = """
         UPDATE tg_users SET tg_user_city = ? WHERE tg_user_id = ?
+        RETURNING id, tg_user_id, tg_user_city, tg_user_phone, tg_user_email, tg_user_first_name, tg_user_last_name
         """
         with self.get_conn() as conn:
             cursor = conn.cursor()
             cursor.execute(query, (tg_user_city, tg_user_id))
+            row = cursor.fetchone()
+            self.write_change(cursor, "users", str(tg_user_id))
+        self.cache_user_row(tg_user_id, row)
 
     # Метод для обновления телефона пользователя
+    @in_executor
     def update_tg_user_phone(self, tg_user_id: int, tg_user_phone: str) -> NoReturn:
         query = """
         UPDATE tg_users SET tg_user_phone = ? WHERE tg_user_id = ?
+        RETURNING id, tg_user_id, tg_user_city, tg_user_phone, tg_user_email, tg_user_first_name, tg_user_last_name
         """
         with self.get_conn() as conn:
             cursor = conn.cursor()
             cursor.execute(query, (tg_user_phone, tg_user_id))
+            row = cursor.fetchone()
+            self.write_change(cursor, "users", str(tg_user_id))
+        self.cache_user_row(tg_user_id, row)
 
     # Метод для обновления почты пользователя
+    @in_executor
     def update_tg_user_email(self, tg_user_id: int, tg_user_email: str) -> NoReturn:
         query = """
         UPDATE tg_users SET tg_user_email = ? WHERE tg_user_id = ?
+        RETURNING id, tg_user_id, tg_user_city, tg_user_phone, tg_user_email, tg_user_first_name, tg_user_last_name
         """
         with self.get_conn() as conn:
             cursor = conn.cursor()
             cursor.execute(query, (tg_user_email, tg_user_id))
+            row = cursor.fetchone()
+            self.write_change(cursor, "users", str(tg_user_id))
+        self.cache_user_row(tg_user_id, row)
 
     # Метод для обновления имени пользователя
+    @in_executor
     def update_tg_user_first_name(self, tg_user_id: int, tg_user_first_name: str) -> NoReturn:
         query = """
         UPDATE tg_users SET tg_user_first_name = ? WHERE tg_user_id = ?
+        RETURNING id, tg_user_id, tg_user_city, tg_user_phone, tg_user_email, tg_user_first_name, tg_user_last_name
         """
         with self.get_conn() as conn:
             cursor = conn.cursor()
             cursor.execute(query, (tg_user_first_name, tg_user_id))
+            row = cursor.fetchone()
+            self.write_change(cursor, "users", str(tg_user_id))
+        self.cache_user_row(tg_user_id, row)
 
     # Метод для обновления фамилии пользователя
+    @in_executor
     def update_tg_user_last_name(self, tg_user_id: int, tg_user_last_name: str) -> NoReturn:
         query = """
         UPDATE tg_users SET tg_user_last_name = ? WHERE tg_user_id = ?
+        RETURNING id, tg_user_id, tg_user_city, tg_user_phone, tg_user_email, tg_user_first_name, tg_user_last_name
         """
         with self.get_conn() as conn:
             cursor = conn.cursor()
             cursor.execute(query, (tg_user_last_name, tg_user_id))
+            row = cursor.fetchone()
+            self.write_change(cursor, "users", str(tg_user_id))
+        self.cache_user_row(tg_user_id, row)
 
     # Метод для получения всего списка пользователей
+    @in_executor
     def list_all_users(
         self,
     ) -> list[User]:
@@ -161,8 +410,48 @@ class Storage:
             for row in rows
         ]
 
-    # Метод для подсчета пользователей
-    def count_all_users(
+    # Метод для получения страницы пользователей, отсортированных по id
+    @in_executor
+    def list_users_page(
+        self,
+        page: int,
+        page_size: int,
+    ) -> list[User]:
+        query = (
+            "SELECT id, tg_user_id, tg_user_city, tg_user_phone, tg_user_email, tg_user_first_name, tg_user_last_name "
+            "FROM tg_users ORDER BY id LIMIT ? OFFSET ?"
+        )
+        with self.get_conn() as conn:
+            cursor = conn.cursor()
+            cursor.execute(query, (page_size, (max(page, 1) - 1) * page_size))
+            rows = cursor.fetchall()
+        return [
+            User(
+                id=row[0],
+                tg_user_id=row[1],
+                tg_user_city=row[2],
+                tg_user_phone=row[3],
+                tg_user_email=row[4],
+                tg_user_first_name=row[5],
+                tg_user_last_name=row[6],
+            )
+            for row in rows
+        ]
+
+    # Метод для подсчета пользователей, значение считается один раз и дальше обновляется при вставке
+    async def count_all_users(
+        self,
+    ) -> int:
+        if self._users_count is None:
+            count = await self.select_count_all_users()
+            with self._users_count_lock:
+                if self._users_count is None:
+                    self._users_count = count
+        return self._users_count
+
+    # Метод для подсчета пользователей в базе данных
+    @in_executor
+    def select_count_all_users(
         self,
     ) -> int:
         query = "SELECT count(1) FROM tg_users"
@@ -173,12 +462,26 @@ class Storage:
 
         return row[0]
 
-    # Метод для получения пользователя по его tg user id
-    def get_user_for_tg_user_id(
+    # Метод для получения пользователя по его tg user id, сначала ищем пользователя в кэше.
+    # Перед этим применяем журнал, чтобы не отдать из кэша пользователя, которого изменил другой процесс
+    async def get_user_for_tg_user_id(
+        self,
+        tg_user_id: int,
+    ) -> Optional[User]:
+        await self.sync_changes()
+        user = self.users_cache.get(tg_user_id)
+        if user is not MISSING:
+            return user
+        return await self.select_user_for_tg_user_id(tg_user_id)
+
+    # Метод для получения пользователя по его tg user id из базы данных
+    @in_executor
+    def select_user_for_tg_user_id(
         self,
         tg_user_id: int,
     ) -> Optional[User]:
         query = "SELECT id, tg_user_id, tg_user_city, tg_user_phone, tg_user_email, tg_user_first_name, tg_user_last_name FROM tg_users WHERE tg_user_id = ?"
+        last_seq = self.changes.last_seq
         with self.get_conn() as conn:
             cursor = conn.cursor()
             cursor.execute(
@@ -186,6 +489,22 @@ class Storage:
                 (tg_user_id,),
             )
             row = cursor.fetchone()
+        self.changes.read(self.apply_changes)
+        # Если пока шел запрос, пользователя могли изменить, не кладем в кэш возможно устаревшее значение
+        if self.changes.last_seq != last_seq:
+            return self.user_from_row(row)
+        return self.cache_user_row(tg_user_id, row)
+
+    # Метод для сохранения строки пользователя из базы данных в кэш.
+    # Отсутствие пользователя тоже кэшируется, чтобы не ходить в базу данных во время регистрации
+    def cache_user_row(self, tg_user_id: int, row: Optional[tuple]) -> Optional[User]:
+        user = self.user_from_row(row)
+        self.users_cache.set(tg_user_id, user)
+        return user
+
+    # Функция для преобразования строки из таблицы tg_users в модель
+    @staticmethod
+    def user_from_row(row: Optional[tuple]) -> Optional[User]:
         if row is None:
             return None
         return User(
@@ -199,6 +518,7 @@ class Storage:
         )
 
     # Метод для получения файла по его id
+    @in_executor
     def get_file_by_id(self, file_id: int) -> Optional[File]:
         query = """
         SELECT id, path_to_file, file_name, mime_type FROM files WHERE id = ? AND valid_until > ?
@@ -211,8 +531,15 @@ class Storage:
             return None
         return File(id=row[0], path_to_file=row[1], file_name=row[2], file_mime_type=row[3])
 
-    # Метод для вставки новой записи о файле
-    def insert_file(self, path_to_file: str, file_name: str, file_mime_type: str, valid_until: int) -> File:
+    # Метод для вставки новой записи о файле и постановки таймера на его удаление
+    async def insert_file(self, path_to_file: str, file_name: str, file_mime_type: str, valid_until: int) -> File:
+        file = await self.insert_file_row(path_to_file, file_name, file_mime_type, valid_until)
+        self.expiry.schedule("files", file.id, valid_until)
+        return file
+
+    # Метод для вставки новой записи о файле в базу данных
+    @in_executor
+    def insert_file_row(self, path_to_file: str, file_name: str, file_mime_type: str, valid_until: int) -> File:
         query = """
         INSERT INTO files(path_to_file, file_name, mime_type, valid_until) VALUES (?, ?, ?, ?)
         RETURNING id, path_to_file, file_name, mime_type
@@ -223,8 +550,15 @@ class Storage:
             row = cursor.fetchone()
         return File(id=row[0], path_to_file=row[1], file_name=row[2], file_mime_type=row[3])
 
-    # Метод для вставки новой записи о токене
-    def insert_token(self, token: str, valid_until: int) -> Token:
+    # Метод для вставки новой записи о токене и постановки таймера на его удаление
+    async def insert_token(self, token: str, valid_until: int) -> Token:
+        token_row = await self.insert_token_row(token, valid_until)
+        self.expiry.schedule("tokens", str(token_row.value), token_row.valid_until)
+        return token_row
+
+    # Метод для вставки новой записи о токене в базу данных
+    @in_executor
+    def insert_token_row(self, token: str, valid_until: int) -> Token:
         query = """
         INSERT INTO tokens(value, valid_until) VALUES (?, ?)
         RETURNING id, value, valid_until
@@ -233,84 +567,423 @@ class Storage:
             cursor = conn.cursor()
             cursor.execute(query, (token, valid_until))
             row = cursor.fetchone()
+        self.tokens_index.add(row[1], row[2])
         return Token(id=row[0], value=row[1], valid_until=row[2])
 
-    # Метод для удаления токена по его значению
+    # Метод для удаления токена по его значению. Другие процессы удалят токен из индекса по журналу изменений
+    @in_executor
     def delete_token(self, value: str) -> NoReturn:
         query = """
         DELETE FROM tokens WHERE value = ?
         """
+        self.tokens_index.discard(value)
         with self.get_conn() as conn:
             cursor = conn.cursor()
             cursor.execute(query, (value,))
+            self.write_change(cursor, "tokens", value)
 
-    # Метод для удаления просроченных токенов
-    def delete_expired_tokens(self) -> NoReturn:
+    # Метод для удаления пачки просроченных токенов по их значениям
+    @in_executor
+    def delete_expired_tokens(self, values: list[str]) -> NoReturn:
         query = """
-        DELETE FROM tokens WHERE valid_until <= ?
-        """
+        DELETE FROM tokens WHERE value IN ({}) AND valid_until <= ?
+        """.format(
+            ", ".join("?" * len(values))
+        )
+        self.tokens_index.expire()
         with self.get_conn() as conn:
             cursor = conn.cursor()
-            exc_info = cursor.execute(query, (datetime.now().timestamp(),))
-        logger.debug(f"Successfully deleted {exc_info.rowcount} expired tokens")
+            cursor.execute(query, (*values, int(datetime.now().timestamp())))
+
+    # Метод для проверки валидности токена. Сначала применяем журнал, чтобы учесть токены, удаленные
+    # другим процессом, и проверяем индекс в памяти, а если токена там нет, проверяем базу данных:
+    # токен мог выдать другой процесс
+    async def is_token_valid(self, token: str) -> bool:
+        await self.sync_changes()
+        if self.tokens_index.is_valid(token):
+            return True
+        return await self.select_valid_token(token)
 
-    # Метод для проверки валидности токена
-    def is_token_valid(self, token: str) -> bool:
+    # Метод для поиска действующего токена в базе данных, найденный токен добавляется в индекс
+    @in_executor
+    def select_valid_token(self, token: str) -> bool:
         query = """
-        SELECT EXISTS(SELECT 1 FROM tokens WHERE value = ? AND valid_until > ?)
+        SELECT valid_until FROM tokens WHERE value = ? AND valid_until > ?
         """
         with self.get_conn() as conn:
             cursor = conn.cursor()
             cursor.execute(query, (token, int(datetime.now().timestamp())))
             row = cursor.fetchone()
-        return row[0]
+        if row is None:
+            return False
+        self.tokens_index.add(token, row[0])
+        return True
 
-    # Метод который работает в фоне для удаления просроченных токенов каждую минуту
-    async def loop_delete_old_tokens(self) -> NoReturn:
-        while True:
-            # every 1 minute
-            await asyncio.sleep(60)
-            logger.debug("Deleting old tokens")
-            try:
-                self.delete_expired_tokens()
-            except Exception as e:
-                logger.exception(
-                    "Critical error caused while deleting old tokens",
-                    e,
-                )
-                continue
-            logger.debug("Successfully deleted old tokens")
-
-    # Метод для удаления просроченных файлов
-    def delete_expired_files(self) -> NoReturn:
+    # Метод для загрузки действующих токенов из базы данных в индекс
+    def load_tokens(self) -> NoReturn:
+        query = """
+        SELECT value, valid_until FROM tokens WHERE valid_until > ?
+        """
+        with self.get_conn() as conn:
+            cursor = conn.cursor()
+            cursor.execute(query, (int(datetime.now().timestamp()),))
+            rows = cursor.fetchall()
+        for row in rows:
+            self.tokens_index.add(row[0], row[1])
+        logger.debug(f"Loaded {len(rows)} valid tokens")
+
+    # Метод для получения таймеров удаления всех токенов и файлов
+    @in_executor
+    def list_expiry_timers(self) -> list[tuple[str, str | int, int]]:
+        with self.get_conn() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT value, valid_until FROM tokens")
+            timers = [("tokens", row[0], row[1]) for row in cursor.fetchall()]
+            cursor.execute("SELECT id, valid_until FROM files")
+            timers.extend(("files", row[0], row[1]) for row in cursor.fetchall())
+            cursor.execute("SELECT key, valid_until FROM llm_answers")
+            timers.extend(("llm_answers", row[0], row[1]) for row in cursor.fetchall())
+        return timers
+
+    # Метод для удаления пачки просроченных файлов по их id.
+    # Выполняется в пуле потоков, поэтому удаление файлов с диска не блокирует event loop
+    @in_executor
+    def delete_expired_files(self, file_ids: list[int]) -> NoReturn:
         query = """
-           DELETE FROM files WHERE valid_until <= ?
+           DELETE FROM files WHERE id IN ({}) AND valid_until <= ?
            RETURNING path_to_file
-           """
+           """.format(
+            ", ".join("?" * len(file_ids))
+        )
         with self.get_conn() as conn:
             cursor = conn.cursor()
-            exc_info = cursor.execute(query, (datetime.now().timestamp(),))
+            cursor.execute(query, (*file_ids, int(datetime.now().timestamp())))
             files = cursor.fetchall()
         for file in files:
-            os.remove(file[0])
-        logger.debug(f"Successfully deleted {exc_info.rowcount} expired files")
-
-    # Метод который работе в фоне для удаления просроченных файлов каждую минуту
-    async def loop_delete_old_files(self) -> NoReturn:
-        while True:
-            # every 1 minute
-            await asyncio.sleep(60)
-            logger.debug("Deleting old files")
             try:
-                self.delete_expired_files()
-            except Exception as e:
-                logger.exception(
-                    "Critical error caused while deleting old files",
-                    e,
-                )
-                continue
-            logger.debug("Successful deleted old files")
+                os.remove(file[0])
+            except FileNotFoundError:
+                logger.warning(f"Expired file {file[0]} already deleted")
+
+    # Метод для получения закэшированного ответа LLM по ключу, возвращает ответ и время, до которого он действует
+    @in_executor
+    def get_llm_answer(self, key: str) -> Optional[tuple[str, int]]:
+        query = """
+        SELECT answer, valid_until FROM llm_answers WHERE key = ? AND valid_until > ?
+        """
+        with self.get_conn() as conn:
+            cursor = conn.cursor()
+            cursor.execute(query, (key, int(datetime.now().timestamp())))
+            row = cursor.fetchone()
+        if row is None:
+            return None
+        return row[0], row[1]
+
+    # Метод для сохранения ответа LLM и постановки таймера на его удаление
+    async def insert_llm_answer(self, key: str, answer: str, valid_until: int) -> NoReturn:
+        await self.insert_llm_answer_row(key, answer, valid_until)
+        self.expiry.schedule("llm_answers", key, valid_until)
+
+    # Метод для сохранения ответа LLM в базу данных
+    @in_executor
+    def insert_llm_answer_row(self, key: str, answer: str, valid_until: int) -> NoReturn:
+        query = """
+        INSERT INTO llm_answers(key, answer, valid_until) VALUES (?, ?, ?)
+        ON CONFLICT(key) DO UPDATE SET answer = excluded.answer, valid_until = excluded.valid_until
+        """
+        with self.get_conn() as conn:
+            cursor = conn.cursor()
+            cursor.execute(query, (key, answer, valid_until))
+
+    # Метод для удаления пачки просроченных ответов LLM
+    @in_executor
+    def delete_expired_llm_answers(self, keys: list[str]) -> NoReturn:
+        query = """
+        DELETE FROM llm_answers WHERE key IN ({}) AND valid_until <= ?
+        """.format(
+            ", ".join("?" * len(keys))
+        )
+        with self.get_conn() as conn:
+            cursor = conn.cursor()
+            cursor.execute(query, (*keys, int(datetime.now().timestamp())))
+
+    # Метод для удаления всех ответов LLM
+    @in_executor
+    def delete_all_llm_answers(self) -> NoReturn:
+        with self.get_conn() as conn:
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM llm_answers")
+
+    # Метод для получения распознанного текста голосового сообщения по file_unique_id из телеграмма
+    @in_executor
+    def get_transcription(self, file_unique_id: str) -> Optional[str]:
+        with self.get_conn() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT text FROM transcriptions WHERE file_unique_id = ?", (file_unique_id,))
+            row = cursor.fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    # Метод для сохранения распознанного текста. Таблица ограничена max_rows записями,
+    # самые старые записи сверх лимита удаляются
+    @in_executor
+    def insert_transcription(self, file_unique_id: str, text: str, max_rows: int) -> NoReturn:
+        query = """
+        INSERT INTO transcriptions(file_unique_id, text, created_at) VALUES (?, ?, ?)
+        ON CONFLICT(file_unique_id) DO UPDATE SET text = excluded.text, created_at = excluded.created_at
+        """
+        trim_query = """
+        DELETE FROM transcriptions WHERE file_unique_id IN (
+            SELECT file_unique_id FROM transcriptions ORDER BY created_at DESC, rowid DESC LIMIT -1 OFFSET ?
+        )
+        """
+        with self.get_conn() as conn:
+            cursor = conn.cursor()
+            cursor.execute(query, (file_unique_id, text, int(datetime.now().timestamp())))
+            cursor.execute(trim_query, (max_rows,))
+
+    # Метод для получения записи FSM по ключу: состояние, данные, номер последнего изменения и время изменения
+    @in_executor
+    def get_fsm_record(self, key: str) -> Optional[tuple[Optional[str], str, int, int]]:
+        with self.get_conn() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT state, data, seq, updated_at FROM fsm WHERE key = ?", (key,))
+            return cursor.fetchone()
+
+    # Метод для сохранения состояния FSM
+    @in_executor
+    def set_fsm_state(self, key: str, state: Optional[str], changes_keep: int) -> tuple[Optional[str], str, int, int]:
+        query = """
+        INSERT INTO fsm(key, state, seq, updated_at) VALUES (?, ?, ?, ?)
+        ON CONFLICT(key) DO UPDATE SET state = excluded.state, seq = excluded.seq, updated_at = excluded.updated_at
+        RETURNING state, data, seq, updated_at
+        """
+        return self.write_fsm_record(query, key, state, changes_keep)
+
+    # Метод для сохранения данных FSM, данные передаются уже в виде JSON
+    @in_executor
+    def set_fsm_data(self, key: str, data: str, changes_keep: int) -> tuple[Optional[str], str, int, int]:
+        query = """
+        INSERT INTO fsm(key, data, seq, updated_at) VALUES (?, ?, ?, ?)
+        ON CONFLICT(key) DO UPDATE SET data = excluded.data, seq = excluded.seq, updated_at = excluded.updated_at
+        RETURNING state, data, seq, updated_at
+        """
+        return self.write_fsm_record(query, key, data, changes_keep)
+
+    # Метод для изменения записи FSM в одной транзакции с записью в журнал изменений.
+    # Просроченная запись сначала удаляется, чтобы старые данные не ожили вместе с новым состоянием.
+    # Пустые записи удаляются, а из журнала удаляются изменения старше последних changes_keep
+    def write_fsm_record(
+        self, query: str, key: str, value: Optional[str], changes_keep: int
+    ) -> tuple[Optional[str], str, int, int]:
+        now = int(datetime.now().timestamp())
+        with self.get_conn() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT state, updated_at FROM fsm WHERE key = ?", (key,))
+            current = cursor.fetchone()
+            if current is not None and current[1] + settings.fsm_ttl(current[0]) <= now:
+                cursor.execute("DELETE FROM fsm WHERE key = ?", (key,))
+            cursor.execute("INSERT INTO fsm_changes(key) VALUES (?) RETURNING seq", (key,))
+            seq = cursor.fetchone()[0]
+            cursor.execute(query, (key, value, seq, now))
+            row = cursor.fetchone()
+            cursor.execute("DELETE FROM fsm WHERE key = ? AND state IS NULL AND data = '{}'", (key,))
+            cursor.execute("DELETE FROM fsm_changes WHERE seq <= ?", (seq - changes_keep,))
+        return row
+
+    # Метод для очистки FSM: удаляет просроченные записи, а если записей или данных больше лимита,
+    # удаляет записи, которые дольше всех не менялись. Удаленные ключи пишутся в журнал изменений,
+    # чтобы их выкинули из кэша все процессы. Возвращает количество просроченных и вытесненных записей
+    @in_executor
+    def compact_fsm(self, max_entries: int, max_bytes: int) -> tuple[int, int]:
+        now = int(datetime.now().timestamp())
+        states = list(settings.fsm_state_ttls)
+        expire_query = """
+        DELETE FROM fsm WHERE (state IS NULL OR state NOT IN ({})) AND updated_at <= ? RETURNING key
+        """.format(
+            ", ".join("?" * len(states))
+        )
+        evict_entries_query = """
+        DELETE FROM fsm WHERE key IN (
+            SELECT key FROM fsm ORDER BY updated_at DESC, key LIMIT -1 OFFSET ?
+        ) RETURNING key
+        """
+        # Размер записи считаем по длине ключа, состояния и данных, накопленную сумму - от самых свежих записей
+        evict_bytes_query = """
+        DELETE FROM fsm WHERE key IN (
+            SELECT key FROM (
+                SELECT key, SUM(LENGTH(key) + COALESCE(LENGTH(state), 0) + LENGTH(CAST(data AS BLOB)))
+                OVER (ORDER BY updated_at DESC, key ROWS UNBOUNDED PRECEDING) AS total
+                FROM fsm
+            ) WHERE total > ?
+        ) RETURNING key
+        """
+        with self.get_conn() as conn:
+            cursor = conn.cursor()
+            expired = []
+            for state, ttl in settings.fsm_state_ttls.items():
+                cursor.execute("DELETE FROM fsm WHERE state = ? AND updated_at <= ? RETURNING key", (state, now - ttl))
+                expired.extend(row[0] for row in cursor.fetchall())
+            cursor.execute(expire_query, (*states, now - settings.fsm_default_ttl))
+            expired.extend(row[0] for row in cursor.fetchall())
+            cursor.execute(evict_entries_query, (max_entries,))
+            evicted = [row[0] for row in cursor.fetchall()]
+            cursor.execute(evict_bytes_query, (max_bytes,))
+            evicted.extend(row[0] for row in cursor.fetchall())
+            cursor.executemany("INSERT INTO fsm_changes(key) VALUES (?)", ((key,) for key in expired + evicted))
+        return len(expired), len(evicted)
+
+    # Метод для получения количества записей FSM в каждом состоянии
+    @in_executor
+    def count_fsm_states(self) -> dict[Optional[str], int]:
+        with self.get_conn() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT state, COUNT(*) FROM fsm GROUP BY state ORDER BY state")
+            return dict(cursor.fetchall())
+
+    # Метод для захвата update_id. Возвращает False, если обновление уже приняли за последние window секунд.
+    # Более старые записи удаляются заодно, их немного, потому что по индексу удаляются только просроченные
+    @in_executor
+    def claim_update(self, update_id: int, window: float) -> bool:
+        now = int(datetime.now().timestamp())
+        with self.get_conn() as conn:
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM webhook_updates WHERE received_at <= ?", (now - window,))
+            cursor.execute(
+                "INSERT OR IGNORE INTO webhook_updates(update_id, received_at) VALUES (?, ?)",
+                (update_id, now),
+            )
+            return cursor.rowcount == 1
+
+    # Метод для отмены захвата update_id
+    @in_executor
+    def release_update(self, update_id: int) -> NoReturn:
+        with self.get_conn() as conn:
+            conn.execute("DELETE FROM webhook_updates WHERE update_id = ?", (update_id,))
+
+    # Метод для получения пачки tg id пользователей с id больше after_id, отсортированных по id
+    @in_executor
+    def list_users_after(self, after_id: int, limit: int) -> list[tuple[int, int]]:
+        with self.get_conn() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT id, tg_user_id FROM tg_users WHERE id > ? ORDER BY id LIMIT ?", (after_id, limit))
+            return cursor.fetchall()
+
+    # Метод для создания рассылки, которую сразу начинает отправлять процесс owner
+    @in_executor
+    def create_broadcast(self, text: str, total: int, owner: str) -> Broadcast:
+        query = """
+        INSERT INTO broadcasts(text, status, total, owner, heartbeat_at, created_at) VALUES (?, 'running', ?, ?, ?, ?)
+        RETURNING {}
+        """.format(
+            BROADCAST_COLUMNS
+        )
+        now = int(datetime.now().timestamp())
+        with self.get_conn() as conn:
+            cursor = conn.cursor()
+            cursor.execute(query, (text, total, owner, now, now))
+            return self.broadcast_from_row(cursor.fetchone())
+
+    # Метод для получения рассылки по id
+    @in_executor
+    def get_broadcast(self, broadcast_id: int) -> Optional[Broadcast]:
+        with self.get_conn() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f"SELECT {BROADCAST_COLUMNS} FROM broadcasts WHERE id = ?", (broadcast_id,))
+            row = cursor.fetchone()
+        if row is None:
+            return None
+        return self.broadcast_from_row(row)
+
+    # Метод для получения последних рассылок
+    @in_executor
+    def list_broadcasts(self, limit: int) -> list[Broadcast]:
+        with self.get_conn() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f"SELECT {BROADCAST_COLUMNS} FROM broadcasts ORDER BY id DESC LIMIT ?", (limit,))
+            return [self.broadcast_from_row(row) for row in cursor.fetchall()]
+
+    # Метод для захвата незаконченных рассылок, которые никто не отправляет дольше lease секунд,
+    # например потому что процесс, который их отправлял, перезапустился
+    @in_executor
+    def claim_stale_broadcasts(self, owner: str, lease: int) -> list[Broadcast]:
+        query = """
+        UPDATE broadcasts SET owner = ?, heartbeat_at = ?
+        WHERE status = 'running' AND heartbeat_at <= ?
+        RETURNING {}
+        """.format(
+            BROADCAST_COLUMNS
+        )
+        now = int(datetime.now().timestamp())
+        with self.get_conn() as conn:
+            cursor = conn.cursor()
+            cursor.execute(query, (owner, now, now - lease))
+            return [self.broadcast_from_row(row) for row in cursor.fetchall()]
+
+    # Метод для продления захвата рассылки процессом owner. Возвращает False, если рассылку уже отправляет
+    # другой процесс или она закончилась
+    @in_executor
+    def heartbeat_broadcast(self, broadcast_id: int, owner: str) -> bool:
+        query = """
+        UPDATE broadcasts SET heartbeat_at = ? WHERE id = ? AND owner = ? AND status = 'running'
+        """
+        with self.get_conn() as conn:
+            cursor = conn.cursor()
+            cursor.execute(query, (int(datetime.now().timestamp()), broadcast_id, owner))
+            return cursor.rowcount == 1
+
+    # Метод для сохранения прогресса рассылки. Возвращает False, если рассылку уже отправляет другой процесс
+    @in_executor
+    def checkpoint_broadcast(
+        self, broadcast_id: int, owner: str, last_user_id: int, sent: int, failed: int, finished: bool
+    ) -> bool:
+        query = """
+        UPDATE broadcasts SET last_user_id = ?, sent = sent + ?, failed = failed + ?, heartbeat_at = ?,
+        status = ?, finished_at = ?
+        WHERE id = ? AND owner = ? AND status = 'running'
+        """
+        now = int(datetime.now().timestamp())
+        with self.get_conn() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                query,
+                (
+                    last_user_id,
+                    sent,
+                    failed,
+                    now,
+                    "finished" if finished else "running",
+                    now if finished else None,
+                    broadcast_id,
+                    owner,
+                ),
+            )
+            return cursor.rowcount == 1
+
+    # Функция для преобразования строки из таблицы broadcasts в модель
+    @staticmethod
+    def broadcast_from_row(row: tuple) -> Broadcast:
+        return Broadcast(
+            id=row[0],
+            text=row[1],
+            status=row[2],
+            total=row[3],
+            sent=row[4],
+            failed=row[5],
+            last_user_id=row[6],
+            created_at=row[7],
+            finished_at=row[8],
+        )
 
 
 # Инициализируем инстанс класса для работы с базой данных
-storage = Storage(settings.db_path)
+storage = Storage(
+    settings.db_path,
+    settings.db_executor_workers,
+    settings.users_cache_size,
+    settings.users_cache_ttl,
+)
+metrics.register_collector("users_cache", storage.users_cache.stats)
+# Настройки, которые поменяли из административной панели другого процесса, перечитываем из файла
+storage.subscribe("settings", lambda _: settings.reload_from_self_file())
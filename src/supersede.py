@@ -0,0 +1,61 @@
+# Модуль для отмены устаревшей работы, когда пользователь присылает новый вопрос
+
+import asyncio
+from typing import Any, Awaitable, Callable, Hashable, Optional
+
+from metrics import (
+    metrics,
+)
+
+
+# Выполняет для каждого владельца только самую новую задачу.
+# Новая задача отменяет предыдущую задачу владельца, если та еще выполняется,
+# а задача, которую опередила более новая, не запускается совсем.
+# Отмена доходит до запросов к внешним сервисам и закрывает их соединения
+class LatestTasks:
+    def __init__(
+        self,
+        name: str,
+    ):
+        self.name = name
+        self._tasks: dict[Hashable, asyncio.Task] = {}
+        # Номер самой новой задачи владельца, которая сейчас выполняется
+        self._latest: dict[Hashable, int] = {}
+        metrics.register_collector(name, self.stats)
+
+    # Метод для выполнения задачи владельца с номером seq.
+    # Вызывается, когда задача уже принята, например прошла все проверки мидлварей, чтобы отклоненная задача
+    # не отменяла предыдущую. Возвращает None, если задачу отменила или опередила более новая задача
+    async def run(self, owner: Hashable, seq: int, fn: Callable[[], Awaitable[Any]]) -> Optional[Any]:
+        if seq < self._latest.get(owner, seq):
+            metrics.inc(f"{self.name}.skipped")
+            return None
+        self._latest[owner] = seq
+        previous = self._tasks.get(owner)
+        if previous is not None and not previous.done():
+            previous.cancel()
+            metrics.inc(f"{self.name}.superseded")
+        task = asyncio.create_task(fn())
+        self._tasks[owner] = task
+        try:
+            return await task
+        except asyncio.CancelledError:
+            # Если отменили саму обработку, а не задачу, отмена должна пойти дальше
+            if asyncio.current_task().cancelling():
+                raise
+            return None
+        finally:
+            if self._tasks.get(owner) is task:
+                del self._tasks[owner]
+            if self._latest.get(owner) == seq:
+                del self._latest[owner]
+
+    # Метод для получения метрик
+    def stats(self) -> dict[str, float]:
+        return {
+            "in_flight": len(self._tasks),
+        }
+
+
+# Инициализируем инстанс для вопросов к LLM, владелец - это чат пользователя
+llm_questions = LatestTasks("llm_questions")
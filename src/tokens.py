@@ -0,0 +1,60 @@
+# Модуль для хранения токенов административной панели в памяти процесса
+
+import heapq
+import threading
+from datetime import datetime
+
+
+# Индекс действующих токенов. Словарь дает проверку токена за O(1),
+# а куча по времени окончания действия позволяет удалять токены ровно тогда, когда они истекают
+class TokenIndex:
+    def __init__(
+        self,
+    ):
+        self._tokens: dict[str, int] = {}
+        self._heap: list[tuple[int, str]] = []
+        self._lock = threading.Lock()
+
+    # Метод для добавления токена
+    def add(self, value: str, valid_until: int):
+        with self._lock:
+            self._tokens[value] = valid_until
+            heapq.heappush(self._heap, (valid_until, value))
+
+    # Метод для удаления токена
+    def discard(self, value: str):
+        with self._lock:
+            # Запись в куче остается и будет пропущена при извлечении
+            self._tokens.pop(value, None)
+
+    # Метод для удаления всех токенов
+    def clear(self):
+        with self._lock:
+            self._tokens.clear()
+            self._heap.clear()
+
+    # Метод для проверки валидности токена
+    def is_valid(self, value: str) -> bool:
+        now = int(datetime.now().timestamp())
+        with self._lock:
+            self._expire(now)
+            valid_until = self._tokens.get(value)
+        return valid_until is not None and valid_until > now
+
+    # Метод для удаления всех истекших токенов, возвращает количество удаленных токенов
+    def expire(self) -> int:
+        with self._lock:
+            return self._expire(int(datetime.now().timestamp()))
+
+    def _expire(self, now: int) -> int:
+        expired = 0
+        while self._heap and self._heap[0][0] <= now:
+            valid_until, value = heapq.heappop(self._heap)
+            # Токен мог быть удален или перевыпущен, поэтому удаляем только если запись совпадает
+            if self._tokens.get(value) == valid_until:
+                del self._tokens[value]
+                expired += 1
+        return expired
+
+    def __len__(self) -> int:
+        return len(self._tokens)
@@ -0,0 +1,70 @@
+# Модуль для кэширования распознанного текста голосовых сообщений.
+# Пересланные и повторно отправленные голосовые приходят с тем же file_unique_id,
+# поэтому их не нужно заново скачивать и распознавать
+
+from typing import Optional
+
+from cache import (
+    TTLCache,
+    MISSING,
+)
+from metrics import (
+    metrics,
+)
+from settings import (
+    settings,
+)
+from storage import (
+    storage,
+)
+
+
+# Кэш распознанного текста из двух уровней: LRU в памяти процесса и ограниченная по размеру таблица в sqlite3
+class TranscriptionCache:
+    def __init__(
+        self,
+        maxsize: int,
+        ttl: int,
+        max_rows: int,
+    ):
+        self.max_rows = max_rows
+        self.memory = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.hits = 0
+        self.misses = 0
+
+    # Метод для получения распознанного текста по file_unique_id
+    async def get(self, file_unique_id: str) -> Optional[str]:
+        text = self.memory.get(file_unique_id)
+        if text is MISSING:
+            text = await storage.get_transcription(file_unique_id)
+            if text is not None:
+                self.memory.set(file_unique_id, text)
+        if text is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return text
+
+    # Метод для сохранения распознанного текста в кэш
+    async def set(self, file_unique_id: str, text: str):
+        self.memory.set(file_unique_id, text)
+        await storage.insert_transcription(file_unique_id, text, self.max_rows)
+
+    # Метод для получения статистики кэша
+    def stats(self) -> dict[str, float]:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / total if total else 0.0,
+            "memory_size": len(self.memory),
+        }
+
+
+# Инициализируем инстанс кэша распознанного текста
+transcription_cache = TranscriptionCache(
+    settings.transcription_cache_size,
+    settings.transcription_cache_ttl,
+    settings.transcription_db_max_rows,
+)
+metrics.register_collector("transcription_cache", transcription_cache.stats)
@@ -0,0 +1,184 @@
+# Модуль для устойчивой работы с внешними сервисами yandex cloud:
+# дублирующие запросы для медленных ответов, повторы при перегрузке и автоматический выключатель
+
+import asyncio
+import random
+import time
+from typing import Any, AsyncIterator, Awaitable, Callable, Optional
+
+import httpx
+from loguru import logger
+
+import exceptions
+from metrics import (
+    metrics,
+)
+from settings import (
+    settings,
+)
+
+
+# Функция для проверки, стоит ли повторять запрос после ошибки
+def is_retryable(e: Exception) -> bool:
+    if isinstance(e, httpx.HTTPStatusError):
+        return e.response.status_code == 429 or e.response.status_code >= 500
+    return isinstance(e, httpx.TransportError)
+
+
+# Функция для получения задержки перед повтором: экспоненциальная с полным разбросом,
+# но не меньше чем просит сервис в заголовке Retry-After
+def retry_delay(e: Exception, attempt: int) -> float:
+    delay = random.uniform(0, settings.upstream_retry_base_delay * 2**attempt)
+    if isinstance(e, httpx.HTTPStatusError):
+        retry_after = e.response.headers.get("Retry-After")
+        if retry_after is not None and retry_after.isdigit():
+            delay = max(delay, float(retry_after))
+    return delay
+
+
+# Класс для вызовов одного внешнего сервиса
+class Upstream:
+    def __init__(
+        self,
+        name: str,
+    ):
+        self.name = name
+        # Гистограмма времени успешных ответов, по ней считается задержка перед дублирующим запросом
+        self.latency = metrics.histogram(f"{name}.latency_seconds")
+        # Состояние автоматического выключателя
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._trial = False
+        metrics.register_collector(name, self.stats)
+
+    # Метод для получения задержки, после которой отправляется дублирующий запрос
+    def hedge_delay(self) -> float:
+        if self.latency.count < settings.upstream_hedge_min_samples:
+            return settings.upstream_hedge_max_delay
+        delay = self.latency.percentile(settings.upstream_hedge_quantile)
+        return min(max(delay, settings.upstream_hedge_min_delay), settings.upstream_hedge_max_delay)
+
+    # Метод для выполнения запроса с повторами, дублированием и автоматическим выключателем
+    async def call(self, fn: Callable[[], Awaitable[Any]], hedge: bool = True) -> Any:
+        attempt = 0
+        while True:
+            self.before_call()
+            try:
+                if hedge and settings.upstream_hedge_enabled:
+                    result = await self._hedged(fn)
+                else:
+                    result = await self._timed(fn)
+            except Exception as e:
+                if not self.after_failure(e, attempt):
+                    raise
+                await asyncio.sleep(retry_delay(e, attempt))
+                attempt += 1
+                continue
+            except BaseException:
+                self.release_trial()
+                raise
+            self.after_success()
+            return result
+
+    # Метод для выполнения потокового запроса. Повтор возможен только пока не получено ни одной части ответа
+    async def stream(self, fn: Callable[[], AsyncIterator[Any]]) -> AsyncIterator[Any]:
+        attempt = 0
+        while True:
+            self.before_call()
+            started = time.monotonic()
+            received = False
+            try:
+                async for item in fn():
+                    if not received:
+                        # Для потокового запроса считаем время до первой части ответа
+                        self.latency.observe(time.monotonic() - started)
+                        received = True
+                    yield item
+            except Exception as e:
+                if received or not self.after_failure(e, attempt):
+                    self.release_trial()
+                    raise
+                await asyncio.sleep(retry_delay(e, attempt))
+                attempt += 1
+                continue
+            except BaseException:
+                self.release_trial()
+                raise
+            self.after_success()
+            return
+
+    # Метод для выполнения запроса с замером времени ответа
+    async def _timed(self, fn: Callable[[], Awaitable[Any]]) -> Any:
+        started = time.monotonic()
+        result = await fn()
+        self.latency.observe(time.monotonic() - started)
+        return result
+
+    # Метод для выполнения запроса с дублированием: если ответа нет дольше обычного,
+    # отправляем второй такой же запрос и берем тот ответ, который придет первым
+    async def _hedged(self, fn: Callable[[], Awaitable[Any]]) -> Any:
+        tasks = {asyncio.create_task(self._timed(fn))}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=self.hedge_delay())
+            if not done:
+                metrics.inc(f"{self.name}.hedged")
+                tasks.add(asyncio.create_task(self._timed(fn)))
+            error: Optional[BaseException] = None
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    # Метод, который вызывается перед запросом, кидает исключение если выключатель разомкнут
+    def before_call(self):
+        if self._opened_at is None:
+            return
+        if self._trial or time.monotonic() - self._opened_at < settings.circuit_breaker_cooldown:
+            metrics.inc(f"{self.name}.rejected")
+            raise exceptions.UpstreamUnavailableException()
+        # Время ожидания прошло, пропускаем один пробный запрос
+        self._trial = True
+
+    # Метод, который вызывается после успешного запроса
+    def after_success(self):
+        if self._opened_at is not None:
+            logger.info(f"Upstream {self.name} recovered")
+        self._failures = 0
+        self._opened_at = None
+        self._trial = False
+
+    # Метод, который вызывается после неуспешного запроса, возвращает True если запрос надо повторить
+    def after_failure(self, e: Exception, attempt: int) -> bool:
+        self._trial = False
+        if not is_retryable(e):
+            return False
+        metrics.inc(f"{self.name}.failures")
+        self._failures += 1
+        if self._failures >= settings.circuit_breaker_failures and self._opened_at is None:
+            logger.warning(f"Upstream {self.name} is degraded, opening circuit breaker")
+            metrics.inc(f"{self.name}.breaker_opened")
+        if self._failures >= settings.circuit_breaker_failures:
+            self._opened_at = time.monotonic()
+            raise exceptions.UpstreamUnavailableException() from e
+        if attempt >= settings.upstream_retries:
+            raise exceptions.UpstreamUnavailableException() from e
+        metrics.inc(f"{self.name}.retries")
+        return True
+
+    # Метод для снятия флага пробного запроса, если запрос прервался без результата
+    def release_trial(self):
+        self._trial = False
+
+    # Метод для получения метрик сервиса
+    def stats(self) -> dict[str, float]:
+        return {
+            "breaker_open": int(self._opened_at is not None),
+            "consecutive_failures": self._failures,
+            "hedge_delay_seconds": self.hedge_delay(),
+        }
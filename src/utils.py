@@ -1,3 +1,4 @@
+import asyncio
 import datetime
 import json
 import os.path
@@ -12,10 +13,13 @@ from storage import storage
 from models import QuestionsFineTuningForm, File
 
 
-def gen_fine_tuning_file(questions: QuestionsFineTuningForm) -> File:
-    file_path = os.path.join(settings.files_dir_path, str(uuid.uuid4()))
+# Путь до файла с шаблонами вопросов и ответов
+TEMPLATE_PATH = pathlib.Path(__file__).parent.resolve() / "template.json"
+
 
-    data_to_fine_tune = {
+# Функция для получения значений, которые подставляются в шаблоны ответов
+def fine_tuning_form_values(questions: QuestionsFineTuningForm) -> dict[str, str]:
+    return {
         "ac_date_start": questions.ac_date_start.strftime("%Y.%m.%d"),
         "ac_date_end": questions.ac_date_end.strftime("%Y.%m.%d"),
         "od_date": questions.od_date.strftime("%Y.%m.%d %H:%M"),
@@ -24,8 +28,29 @@ def gen_fine_tuning_file(questions: QuestionsFineTuningForm) -> File:
         "od_address": questions.od_address,
         "fod": questions.fod,
     }
-    with open(pathlib.Path(__file__).parent.resolve() / "template.json") as f:
-        content = json.load(f)
+
+
+# Функция для загрузки шаблонов вопросов и ответов
+def load_template() -> list[dict[str, str]]:
+    with open(TEMPLATE_PATH) as f:
+        return json.load(f)
+
+
+async def gen_fine_tuning_file(questions: QuestionsFineTuningForm) -> File:
+    file_path = os.path.join(settings.files_dir_path, str(uuid.uuid4()))
+
+    data_to_fine_tune = fine_tuning_form_values(questions)
+    # Генерация файла блокирующая, поэтому выполняем ее вне event loop
+    await asyncio.to_thread(write_fine_tuning_file, file_path, data_to_fine_tune)
+
+    file = await storage.insert_file(
+        file_path, "gen.json", "application/json", int((datetime.datetime.now().timestamp() + 3600))
+    )
+    return file
+
+
+def write_fine_tuning_file(file_path: str, data_to_fine_tune: dict[str, str]):
+    content = load_template()
     with jsonlines.open(file_path, "w") as f:
         for pair in content:
             answer = string.Template(pair["answer"]).substitute(data_to_fine_tune)
@@ -42,8 +67,3 @@ def gen_fine_tuning_file(questions: QuestionsFineTuningForm) -> File:
                 "response": answer,
             }
             f.write(d)
-
-    file = storage.insert_file(
-        file_path, "gen.json", "application/json", int((datetime.datetime.now().timestamp() + 3600))
-    )
-    return file
@@ -0,0 +1,106 @@
+# Модуль для обработки задач пулом воркеров с сохранением порядка задач внутри одного чата
+
+import asyncio
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Hashable, Optional
+
+from loguru import logger
+
+from metrics import (
+    metrics,
+)
+
+
+# Пул воркеров, который выполняет задачи из общей очереди ограниченного размера.
+# Задачи одного чата выполняются строго по очереди одним воркером за раз,
+# а задачи разных чатов выполняются параллельно
+class ChatOrderedPool:
+    def __init__(
+        self,
+        name: str,
+        workers: int,
+        max_queue: int,
+        handler: Callable[[Any], Awaitable[Any]],
+    ):
+        self.name = name
+        self.workers = workers
+        self.max_queue = max_queue
+        self.handler = handler
+        # Задачи, ожидающие выполнения, по каждому чату. Чат есть в словаре, пока у него есть
+        # невыполненные задачи или одна из его задач выполняется прямо сейчас
+        self._pending: dict[Hashable, deque[tuple[Any, float]]] = {}
+        # Очередь чатов, у которых можно брать следующую задачу
+        self._ready: asyncio.Queue[Hashable] = asyncio.Queue()
+        self._queued = 0
+        self._busy = 0
+        self._tasks: list[asyncio.Task] = []
+        self.latency = metrics.histogram(f"{name}.latency_seconds")
+        self.wait = metrics.histogram(f"{name}.wait_seconds")
+        metrics.register_collector(name, self.stats)
+
+    # Метод для добавления задачи в очередь, возвращает False если очередь заполнена
+    def submit(self, key: Hashable, item: Any) -> bool:
+        if self._queued >= self.max_queue:
+            metrics.inc(f"{self.name}.rejected")
+            return False
+        self._queued += 1
+        queue = self._pending.get(key)
+        if queue is None:
+            self._pending[key] = deque([(item, time.monotonic())])
+            self._ready.put_nowait(key)
+        else:
+            # Чат уже в очереди или его задача выполняется, задача выполнится после предыдущих
+            queue.append((item, time.monotonic()))
+        return True
+
+    # Метод для проверки, есть ли у чата задачи в очереди или в работе
+    def pending(self, key: Hashable) -> bool:
+        return key in self._pending
+
+    # Метод для запуска воркеров
+    def start(self):
+        self._tasks = [asyncio.create_task(self.run()) for _ in range(self.workers)]
+
+    # Метод для остановки воркеров. Сначала ждем timeout секунд, пока выполнятся задачи из очереди
+    async def stop(self, timeout: Optional[float] = None):
+        try:
+            await asyncio.wait_for(self._ready.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Pool {self.name} stopped with {self._queued} unprocessed tasks")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    # Цикл воркера
+    async def run(self):
+        while True:
+            key = await self._ready.get()
+            queue = self._pending[key]
+            item, enqueued_at = queue.popleft()
+            self._queued -= 1
+            self._busy += 1
+            started = time.monotonic()
+            self.wait.observe(started - enqueued_at)
+            try:
+                await self.handler(item)
+            except Exception:
+                logger.exception(f"Unhandled error in pool {self.name}")
+            finally:
+                self.latency.observe(time.monotonic() - enqueued_at)
+                self._busy -= 1
+                if queue:
+                    # Следующая задача чата встает в конец очереди, чтобы не задерживать другие чаты
+                    self._ready.put_nowait(key)
+                else:
+                    del self._pending[key]
+                self._ready.task_done()
+
+    # Метод для получения метрик пула
+    def stats(self) -> dict[str, float]:
+        return {
+            "queued": self._queued,
+            "busy_workers": self._busy,
+            "chats": len(self._pending),
+        }